@@ -21,11 +21,14 @@
 """
 The public API of couchable consists of:
     - L{CouchableDb}: The core DB wrapper/access object.
+    - L{CoalescingLoader}: Batches up concurrent loads into fewer requests.
+    - L{defineClassView}: For declaring views, to be synced by L{CouchableDb.syncViews}.
     - L{packer}: Extends the list of built-in or C types supported.
     - L{registerDocType}, L{CouchableDoc}: For adding new document classes.
     - L{registerAttachmentType}, L{CouchableAttachment}: For adding classes to store as attachments.
     - L{doGzip}, L{doGunzip}: Helper functions for compressing attachments.
     - L{newid}: Helper function to make document IDs readable.
+    - L{setTracing}: Turns debug tracing on or off per subsystem.
 
 For more information, please see:
     - API docs: U{http://packages.python.org/couchable}
@@ -41,10 +44,12 @@ From the README.txt:
 --README.txt--
 """
 
-from core import CouchableDb
+from core import CouchableDb, CoalescingLoader
+from core import defineClassView
 from core import registerDocType, CouchableDoc
 from core import registerAttachmentType, CouchableAttachment
 from core import registerPickleType, registerNoneType, registerUncouchableType
 from core import custom_packer
 from core import doGzip, doGunzip
 from core import newid
+from core import setTracing
@@ -30,38 +30,117 @@ log_internal.setLevel(logging.WARN)
 """
 foo
 """
+import array
 import base64
+import codecs
 import collections
+import contextlib
 import copy
 import cPickle as pickle
 import cStringIO
-import datetime
 import gzip
 import hashlib
 import inspect
 import itertools
+import operator
 import os
 import pprint
+import Queue
 import random
-import re
 import string
-import subprocess
 import sys
-import tempfile
+import threading
 import time
-import traceback
-import uuid
 import weakref
 
 #import yaml
 import couchdb
 import couchdb.client
-import couchdb.design
 import couchdb.http
 import couchdb.json
-import couchdb.multipart
 
-import requests
+# Not imported up front, since they're slow to import and only needed for
+# some calls: couchdb.design (addClassView), couchdb.multipart (storing
+# large attachments), uuid (newid).
+
+class _Trace(object):
+    """
+    Cheap debug tracing for one subsystem of couchable.  Each subsystem has
+    its own logger under C{couchable.internal} (or C{couchable.api}), and
+    C{.on} is a plain attribute so hot paths can check it before doing any
+    formatting, C{getattr} or C{repr} work::
+
+        if _trace_pack.on:
+            _trace_pack("{}: {}", type(data), name)
+
+    The flag is cached, and gets refreshed by L{setTracing} and at the
+    start of every L{CouchableDb.store} and L{CouchableDb.load} call, so
+    logger levels set by hand take effect on the next call.  Under
+    C{python -O} tracing is always off.
+
+    >>> trace = _Trace('couchable.internal.doctest')
+    >>> trace.on
+    False
+    """
+    __slots__ = ('logger', 'level', 'on')
+
+    def __init__(self, logger_name, level=logging.DEBUG):
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+        self.refresh()
+
+    def refresh(self):
+        self.on = __debug__ and self.logger.isEnabledFor(self.level)
+
+    def __call__(self, msg, *args):
+        if self.on:
+            self.logger.log(self.level, msg.format(*args))
+
+_trace_dict = collections.OrderedDict([
+        ('api', _Trace(log_api.name, logging.INFO)),
+        ('store', _Trace(log_internal.name + '.store')),
+        ('pack', _Trace(log_internal.name + '.pack')),
+        ('load', _Trace(log_internal.name + '.load')),
+        ('compress', _Trace(log_internal.name + '.compress')),
+    ])
+_trace_api = _trace_dict['api']
+_trace_store = _trace_dict['store']
+_trace_pack = _trace_dict['pack']
+_trace_load = _trace_dict['load']
+_trace_compress = _trace_dict['compress']
+
+def _refreshTracing():
+    for trace in _trace_dict.values():
+        trace.refresh()
+
+def setTracing(subsystem=None, enabled=True):
+    """
+    Turns tracing on or off for one subsystem of couchable (or all of them).
+    This just sets the level of the subsystem's logger (C{DEBUG}, or
+    C{INFO} for C{'api'}, when enabled, C{WARN} otherwise); the messages
+    still need a handler to go anywhere.
+
+    >>> setTracing('pack')
+    >>> _trace_pack.on, _trace_load.on
+    (True, False)
+    >>> setTracing(enabled=False)
+    >>> _trace_pack.on
+    False
+
+    @type  subsystem: str
+    @param subsystem: One of C{'api'} (store/load calls), C{'store'}, C{'pack'}, C{'load'} or C{'compress'}.  Defaults to None (all of them).
+    @type  enabled: bool
+    @param enabled: Whether tracing messages should be logged.
+    """
+    if subsystem is None:
+        trace_list = _trace_dict.values()
+    else:
+        trace_list = [_trace_dict[subsystem]]
+
+    for trace in trace_list:
+        trace.logger.setLevel(trace.level if enabled else logging.WARN)
+
+    _refreshTracing()
 
 def importstr(module_str, from_=None):
     """
@@ -88,31 +167,44 @@ def typestr(type_):
 
 FIELD_NAME = 'couchable:'
 
+# (module, class) names to classes, for unpacking; docs of many different
+# classes (say, from a view with subclasses=True) each cost a dict lookup.
+_cls_cache = {}
+
 class UncouchableException(Exception):
     def __init__(self, msg, cls, obj):
         Exception.__init__(self, msg)
         self.cls = cls
         self.obj = obj
 
-# type packing / unpacking
+class StoreConflictException(Exception):
+    def __init__(self, msg, conflict_list):
+        Exception.__init__(self, msg)
+        self.conflict_list = conflict_list
+
+# type packing / unpacking; registering handlers (and findHandler's
+# iteration) holds _handler_lock, since other threads may be packing.
+_handler_lock = threading.RLock()
 _pack_handlers = collections.OrderedDict()
 _unpack_handlers = collections.OrderedDict()
 def _packer(*args):
     def func(func_):
-        for type_ in args:
-            _pack_handlers[type_] = func_
-            _pack_handlers[typestr(type_)] = func_
-            #packer(type_, func_)
+        with _handler_lock:
+            for type_ in args:
+                _pack_handlers[type_] = func_
+                _pack_handlers[typestr(type_)] = func_
+                #packer(type_, func_)
 
         def func__(self, parent_doc, data, *args, **kwargs):
-            if id(data) in self._cycle_set:
+            cycle_set = self._ctx.cycle_set
+            if id(data) in cycle_set:
                 raise ValueError("Object {} is cycle root: {!r}, {}".format(id(data), args[1], type(data)))#, data))
 
             try:
-                self._cycle_set.add(id(data))
+                cycle_set.add(id(data))
                 return func_(self, parent_doc, data, *args, **kwargs)
             finally:
-                self._cycle_set.remove(id(data))
+                cycle_set.remove(id(data))
 
         return func__
     return func
@@ -127,11 +219,12 @@ def custom_packer(type_, pack_func, unpack_func, simple=True):
         _pack_func = pack_func
         _unpack_func = unpack_func
 
-    _pack_handlers[type_] = _pack_func
-    _pack_handlers[typestr(type_)] = _pack_func
+    with _handler_lock:
+        _pack_handlers[type_] = _pack_func
+        _pack_handlers[typestr(type_)] = _pack_func
 
-    _unpack_handlers[type_] = _unpack_func
-    _unpack_handlers[typestr(type_)] = _unpack_func
+        _unpack_handlers[type_] = _unpack_func
+        _unpack_handlers[typestr(type_)] = _unpack_func
 
     return _ret_func, _unpack_func
 
@@ -163,13 +256,347 @@ def findHandler(cls_or_name, handler_dict):
     if (cls_or_name,) in handler_dict:
         return handler_dict[(cls_or_name,)]
     elif isinstance(cls_or_name, type):
-        for type_, handler in reversed(handler_dict.items()):
-            if isinstance(type_, type) and issubclass(cls_or_name, type_):
-                handler_dict[(cls_or_name,)] = type_, handler
-                return type_, handler
+        # OrderedDict isn't safe to iterate while another thread adds to it.
+        with _handler_lock:
+            for type_, handler in reversed(handler_dict.items()):
+                if isinstance(type_, type) and issubclass(cls_or_name, type_):
+                    handler_dict[(cls_or_name,)] = type_, handler
+                    return type_, handler
 
     return None, None
 
+class _StoreContext(object):
+    """
+    The working state of a single L{CouchableDb.store} call.  Kept on a
+    per-thread stack (see L{CouchableDb._storeContext}) rather than on the
+    CouchableDb itself, so that several threads can store through the same
+    instance, and so that store can be called again from inside a preStore
+    callback.
+    """
+    __slots__ = ('skip_list', 'additiveOnly', 'done_dict', 'cycle_set', 'store_deque', 'ref_dict', 'written_set')
+
+    def __init__(self, skip=None, additiveOnly=False, written_set=None):
+        if skip is None:
+            self.skip_list = []
+        else:
+            self.skip_list = [x for x in skip if hasattr(x, '_id') and hasattr(x, '_rev')]
+
+        self.additiveOnly = additiveOnly
+        self.done_dict = collections.OrderedDict()
+        self.cycle_set = set()
+        self.store_deque = collections.deque()
+        self.ref_dict = {}
+
+        # IDs of referenced docs that have already been written (see storeIter).
+        if written_set is None:
+            self.written_set = frozenset()
+        else:
+            self.written_set = written_set
+
+class _PathName(object):
+    """
+    Lazily formatted name of the value being packed, like C{'self.foo[3]'}.
+
+    Formatting a name for every value packed is expensive, and the names are
+    only needed for pickle/attachment names and error messages, so the
+    string is only built when something asks for it.
+
+    >>> name = _PathName(_PathName('self', '{}.{!s}', 'foo'), '{}[{}]', 3)
+    >>> str(name)
+    'self.foo[3]'
+    >>> '{}>{}'.format(name, 'bar')
+    'self.foo[3]>bar'
+    """
+    __slots__ = ('parent', 'format_str', 'key')
+
+    def __init__(self, parent, format_str, key):
+        self.parent = parent
+        self.format_str = format_str
+        self.key = key
+
+    def __str__(self):
+        node_list = []
+        node = self
+        while isinstance(node, _PathName):
+            node_list.append(node)
+            node = node.parent
+
+        name = str(node)
+        for node in reversed(node_list):
+            name = node.format_str.format(name, node.key)
+
+        return name
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+    def __repr__(self):
+        return repr(str(self))
+
+# Back-references to objects shared within a document, see CouchableDb._pack_ref.
+_ref_prefix = FIELD_NAME + 'ref:'
+
+# Keys that never get packed, no matter where they show up.
+_skip_key_set = frozenset(['_attachments', '_cdb', '_couchableMultipartPending'])
+
+class _BoundedConnectionPool(couchdb.http.ConnectionPool):
+    """
+    A couchdb.http.ConnectionPool that keeps at most C{maxsize} idle
+    connections per host (extras get closed when they're released), or
+    none at all if C{keepAlive} is False.
+    """
+
+    def __init__(self, timeout, maxsize=None, keepAlive=True):
+        couchdb.http.ConnectionPool.__init__(self, timeout)
+        self.maxsize = maxsize
+        self.keepAlive = keepAlive
+
+    def release(self, url, conn):
+        if self.keepAlive:
+            scheme, host = couchdb.http.util.urlsplit(url, 'http', False)[:2]
+
+            with self.lock:
+                conn_list = self.conns.setdefault((scheme, host), [])
+                if self.maxsize is None or len(conn_list) < self.maxsize:
+                    conn_list.append(conn)
+                    return
+
+        conn.close()
+
+_session_dict = {}
+_session_lock = threading.Lock()
+_session_pid = None
+def _getSession(server_url, timeout=None, poolSize=None, keepAlive=True):
+    """
+    Returns the process-wide couchdb.Session for C{server_url} with the given
+    settings, creating it if needed.  The registry starts over in a child
+    process after a fork, so that children never use the sockets that they
+    inherited from their parent.
+
+    >>> _getSession('http://localhost:5984') is _getSession('http://localhost:5984/')
+    True
+    >>> _getSession('http://localhost:5984', 5) is _getSession('http://localhost:5984')
+    False
+    >>> _getSession('http://localhost:5984', 5).connection_pool.timeout
+    5
+    """
+    global _session_pid
+
+    key = (server_url.rstrip('/'), timeout, poolSize, keepAlive)
+
+    with _session_lock:
+        if _session_pid != os.getpid():
+            _session_dict.clear()
+            _session_pid = os.getpid()
+
+        session = _session_dict.get(key)
+        if session is None:
+            session = _session_dict[key] = couchdb.Session(timeout=timeout)
+            session.connection_pool = _BoundedConnectionPool(timeout, poolSize, keepAlive)
+
+    return session
+
+_threadPool = None
+_threadPool_lock = threading.Lock()
+_threadPool_pid = None
+_threadPool_size = 8
+def _getThreadPool():
+    """
+    Returns the process-wide C{multiprocessing.pool.ThreadPool} used by
+    L{CouchableDb.storeAsync} and friends.  It's only created on first use,
+    and a new one is made in a child process after a fork (the threads of
+    the parent's pool don't exist there).
+    """
+    global _threadPool, _threadPool_pid
+
+    with _threadPool_lock:
+        if _threadPool_pid != os.getpid():
+            import multiprocessing.pool
+            _threadPool = multiprocessing.pool.ThreadPool(_threadPool_size)
+            _threadPool_pid = os.getpid()
+
+    return _threadPool
+
+# URLs of the databases that this process has seen exist, see CouchableDb._checkDb.
+_existingDb_set = set()
+
+# Doc size sampling, see CouchableDb.storeIter.
+_storeIter_sampleMin = 8
+_storeIter_sampleEvery = 64
+
+# Patches, see CouchableDb._writePatches.
+_patchCacheBytes = 32 * 2**20
+_patchMinLen = 4096
+_patch_js = '''
+    function(doc, req) {
+        var patch = JSON.parse(req.body);
+        if (!doc || doc._rev != patch.rev) {
+            // A JSON error body; couchdb-python mishandles plain text ones.
+            return [null, {code: 409, json: {error: 'conflict', reason: 'Document update conflict.'}}];
+        }
+
+        function parent(path) {
+            var target = doc;
+            for (var i = 0; i < path.length - 1; i++) {
+                target = target[path[i]];
+            }
+            return target;
+        }
+
+        patch.set.forEach(function(item) {
+            parent(item[0])[item[0][item[0].length - 1]] = item[1];
+        });
+        patch.unset.forEach(function(path) {
+            delete parent(path)[path[path.length - 1]];
+        });
+
+        return [doc, 'patched'];
+    }'''
+
+_docPatch_skip = frozenset(['_id', '_rev', '_attachments'])
+def _docPatch(old_doc, new_doc, path=()):
+    """
+    Returns C{(set_list, unset_list)}: the C{(path, value)} pairs and the
+    paths that turn C{old_doc} into C{new_doc}.  Dicts are compared key by
+    key, everything else as a whole.
+
+    >>> _docPatch({'_rev': '1', 'a': 1, 'b': {'c': 2, 'd': 3}, 'e': 4.0}, {'_rev': '2', 'a': 1, 'b': {'c': 5}, 'e': 4})
+    ([(('b', 'c'), 5), (('e',), 4)], [('b', 'd')])
+    """
+    set_list = []
+    unset_list = []
+
+    for k, v in sorted(new_doc.items()):
+        if not path and k in _docPatch_skip:
+            continue
+
+        if k not in old_doc:
+            set_list.append((path + (k,), v))
+            continue
+
+        old_v = old_doc[k]
+        if isinstance(v, dict) and isinstance(old_v, dict):
+            sub_set_list, sub_unset_list = _docPatch(old_v, v, path + (k,))
+            set_list.extend(sub_set_list)
+            unset_list.extend(sub_unset_list)
+
+        # 1 == 1.0, but they don't come back as the same type.
+        elif old_v != v or (isinstance(v, (float, list)) or isinstance(old_v, (float, list))) and couchdb.json.encode(old_v) != couchdb.json.encode(v):
+            set_list.append((path + (k,), v))
+
+    for k in sorted(old_doc):
+        if k not in new_doc and not (not path and k in _docPatch_skip):
+            unset_list.append(path + (k,))
+
+    return set_list, unset_list
+
+# Views
+_syncViews_attempts = 3
+_classView_dict = collections.OrderedDict()
+_classViewDesign_dict = {}
+_syncedView_dict = {}
+def defineClassView(cls, name, keys=None, multikeys=None, value='1', reduce=None, designDoc='couchable', subclasses=False, linked=None, condition=None):
+    """
+    Defines a view that only emits records for documents of the specified
+    class.  Each record also emits keys based on the parameters given, which
+    can be used for things like "get all Foo instances with bar between 3
+    and 7."  The view gets written to the database by
+    L{CouchableDb.syncViews} (or L{CouchableDb.addClassView}).
+
+    The view code resembles the following::
+
+        function(doc) {
+            if ('couchable:' in doc) {
+                var info = doc['couchable:'];
+                if (info.module == '$module' && info.class == '$cls') {
+                    $emit
+                }
+            }
+        }
+
+    With C{subclasses}, the condition also accepts documents that list
+    C{cls} among their bases, which documents stored by a CouchableDb with
+    C{classHierarchy=True} do.
+
+    With C{linked}, each key gets a C{0} appended, and each of the named
+    attributes that refers to another document (directly, or as a list of
+    references) gets extra rows keyed C{[..., n, j]} with the value
+    C{{_id: ..., 'couchable:linked': true}}.  Queried with C{include_docs}, those rows carry the
+    referenced docs, and L{CouchableDb.load} uses them instead of fetching
+    the docs itself (the extra rows don't show up in what gets returned).
+    Ranges like C{startkey=[3], endkey=[3, {}]} still work, but exact
+    C{key} lookups need the trailing C{0}.
+
+    I{This behavior may change during the course of the 0.x.x series of releases.}
+
+    @type  cls: type
+    @param cls: The class of objects that the view should be restricted to.  Note that sub/superclasses are not considered, unless C{subclasses} is True.
+    @type  name: string
+    @param name: The string to suffix the name of the view with (byclass+module.class:name).
+    @type  keys: list of strings
+    @param keys: A list of unescaped javascript expressions to use as the key for the view.
+    @type  multikeys: list of list of strings
+    @param multikeys: A list of keys (see above).  Each key will get a separate emit.
+    @type  value: string
+    @param value: A string of unescaped javascript used as the value of each emit.
+    @type  reduce: string
+    @param reduce: A CouchDB reduce function.  Can be None, javascript, or the built-in '_sum' kind of reduce function.
+    @type  designDoc: string
+    @param designDoc: The design doc to put the view in.  Changing any view in a design doc makes CouchDB rebuild all of them, so views that change independently can go in separate design docs.
+    @type  subclasses: bool
+    @param subclasses: Include instances of subclasses of C{cls} (that were stored with C{classHierarchy=True}).
+    @type  linked: list of strings
+    @param linked: Attribute names of references to other documents to emit rows for.
+    @type  condition: string
+    @param condition: A string of unescaped javascript; only documents for which it's true are emitted.
+    @rtype: str
+    @return: The full name of the view (byclass+module.class+name).
+    """
+    def attr_js(attr):
+        return 'info.private.' + attr if attr[0] == '_' else 'doc.' + attr
+
+    multikeys = multikeys or [keys]
+    key_list = [[attr_js(key) for key in keys] for keys in multikeys]
+
+    # With linked docs, the doc's own row gets a trailing 0 and the rows for
+    # its references get 1..n, so that every row has its own (key, docid).
+    emit_js = '\n'.join(['''emit([{}], {});'''.format(', '.join(key_js + (['0'] if linked else [])), value) for key_js in key_list])
+
+    for i, attr in enumerate(linked or []):
+        for key_js in key_list:
+            emit_js += '''
+                    [].concat({}).forEach(function(ref, j) {{
+                        if (typeof ref == 'string' && ref.indexOf('{}') == 0) {{
+                            emit([{}, j], {{_id: ref.substring({}), '{}': true}});
+                        }}
+                    }});'''.format(attr_js(attr), FIELD_NAME + 'id:', ', '.join(key_js + [str(i + 1)]), len(FIELD_NAME + 'id:'), FIELD_NAME + 'linked')
+
+    byclass_js = '''
+        function(doc) {
+            if ('couchable:' in doc) {
+                var info = doc['couchable:'];
+                if ($match) {
+                    $emit
+                }
+            }
+        }'''
+
+    match_js = "info.module == '$module' && info.class == '$cls'"
+    if subclasses:
+        match_js = "({}) || (info.mro && info.mro.indexOf('$module.$cls') != -1)".format(match_js)
+    if condition:
+        match_js = "({}) && ({})".format(match_js, condition)
+
+    byclass_js = string.Template(byclass_js).safe_substitute(match=match_js)
+    byclass_js = string.Template(byclass_js).safe_substitute(module=cls.__module__, cls=cls.__name__, emit=emit_js, value=value)
+
+    fullName = 'byclass-{}-{}--{}'.format(cls.__module__, cls.__name__, name)
+
+    _classView_dict[(designDoc, fullName)] = (byclass_js, reduce)
+    _classViewDesign_dict[fullName] = designDoc
+
+    return fullName
+
 class CouchableDb(object):
     """
     Currently, though it is not documented here, the .db parameter is part of
@@ -184,23 +611,51 @@ class CouchableDb(object):
     """
 
     _obj_by_id_cache = weakref.WeakValueDictionary()
+    _obj_by_id_lock = threading.RLock()
     _cls2srcMd5sum_dict = {}
 
-    def __init__(self, url=None, db=None, exists=None, timeout=None):
+    def __init__(self, url=None, db=None, exists=None, lazy=False, timeout=None, poolSize=None, keepAlive=True, columnarMinLen=None, arrayMinLen=None, shareRefs=False, classHierarchy=False, patchUpdates=False):
         """
         Creates a CouchableDb wrapper around a couchdb.Database object.  If
         the database does not yet exist, it will be created.
 
+        All CouchableDb instances in a process that talk to the same server
+        with the same C{timeout}, C{poolSize} and C{keepAlive} share a single
+        couchdb.Session (and so a single pool of connections); see
+        L{_getSession}.
+
         @type  name: str
         @param name: Name of the CouchDB database to connect to.
         @type  url: str
         @param url: The URL of the CouchDB server.  Uses the couchdb default of http://localhost:5984/
         @type  db: couchdb.Database
         @param db: An instance of couchdb.Database that has already been instantiated.  Overrides the name and url params.
+        @type  exists: bool
+        @param exists: If True, the database is assumed to exist, and isn't checked for or created.
+        @type  lazy: bool
+        @param lazy: If True, no requests are made until the database is first used, and the database is only checked for (and created) if this process hasn't already seen it exist.  Defaults to False.
+        @type  timeout: float
+        @param timeout: Socket timeout in seconds.  Defaults to None (no timeout).
+        @type  poolSize: int
+        @param poolSize: The most idle connections to keep open to the server.  Defaults to None (unlimited).
+        @type  keepAlive: bool
+        @param keepAlive: If False, connections get closed after each request rather than reused.  Defaults to True.
+        @type  columnarMinLen: int
+        @param columnarMinLen: Lists at least this long whose elements are all plain objects of the same class and attribute set will be stored one column per attribute.  Defaults to None (disabled).
+        @type  arrayMinLen: int
+        @param arrayMinLen: Lists at least this long that hold only floats (or only 32 bit ints) will be stored as compressed binary.  Defaults to None (disabled).
+        @type  shareRefs: bool
+        @param shareRefs: If True, a non-document object that shows up more than once inside a single document is only packed once; later occurrences are stored as references to it, and loading gives back one shared instance (this also allows cycles between such objects).  Objects inside columnar lists aren't shared.  Defaults to False.
+        @type  classHierarchy: bool
+        @param classHierarchy: If True, top-level documents record the names of all of their classes' base classes, so that views defined with C{subclasses=True} (see L{defineClassView}) include them.  Defaults to False.
+        @type  patchUpdates: bool
+        @param patchUpdates: If True, the last stored (or loaded) version of recent large documents is kept (up to 32MB of them), and storing a large document that has only changed a little sends just the changes (see L{_writePatches}).  Defaults to False.
         """
 
         self._db_pid = None
         self._db = None
+        self._db_exists = bool(exists)
+        self._session_args = (timeout, poolSize, keepAlive)
 
         if db is not None:
             assert url is None
@@ -213,23 +668,27 @@ class CouchableDb(object):
             if '/' not in url:
                 url = 'http://localhost:5984/' + url
 
-            self.db = couchdb.Database(url, session=couchdb.Session(timeout=timeout))
+            self.db = couchdb.Database(url, session=_getSession(url.rstrip('/').rsplit('/', 1)[0], *self._session_args))
 
-        self.url = self.db.resource.url
+        self.url = self._db.resource.url
         self.server_url, self.name = self.url.rstrip('/').rsplit('/', 1)
-        self.server = couchdb.Server(self.server_url)
+        self.server = couchdb.Server(self.server_url, session=self._db.resource.session)
 
-        if not exists:
-            if requests.head(self.url).status_code != 200:
-                put_dict = requests.put(self.url).json()
-                if 'ok' not in put_dict:
-                    raise Exception("Could not create DB: {!r}".format(put_dict))
+        if not exists and not lazy:
+            self._checkDb()
 
 
         # This dance is odd due to the semantics of how WVD works.
         cache_key = self.url
-        self._obj_by_id = self._obj_by_id_cache.get(cache_key, weakref.WeakValueDictionary())
-        self._obj_by_id_cache[cache_key] = self._obj_by_id
+        with self._obj_by_id_lock:
+            self._obj_by_id = self._obj_by_id_cache.get(cache_key, weakref.WeakValueDictionary())
+            self._obj_by_id_cache[cache_key] = self._obj_by_id
+
+        self._local = threading.local()
+        self._writeBehind = None
+
+        self.retryStats = collections.Counter()
+        self._retryStats_lock = threading.Lock()
 
         #self.url = url
         #self.name = name
@@ -249,6 +708,15 @@ class CouchableDb(object):
         #self.db = db
 
         self._maxStrLen = 1024
+        self._columnarMinLen = columnarMinLen
+        self._arrayMinLen = arrayMinLen
+        self._shareRefs = shareRefs
+        self._classHierarchy = classHierarchy
+
+        self._patchUpdates = patchUpdates
+        self._packed_dict = collections.OrderedDict()
+        self._packed_bytes = 0
+        self._packed_lock = threading.Lock()
 
         #self._init_views()
         #
@@ -263,60 +731,86 @@ class CouchableDb(object):
     #
     #    couchdb.design.ViewDefinition('couchable', 'byclass', byclass_js).sync(self.db)
 
-    def addClassView(self, cls, name, keys=None, multikeys=None, value='1', reduce=None):
+    def addClassView(self, cls, name, keys=None, multikeys=None, value='1', reduce=None, designDoc='couchable', subclasses=False, linked=None):
         """
-        Creates a view that only emits records for documents of the specified
-        class.  Each record also emits keys based on the parameters given, which
-        can be used for things like "get all Foo instances with bar between 3
-        and 7."
+        Calls L{defineClassView}, and then L{syncViews} for the design doc
+        that the view is in.  When there are a lot of views to set up, it's
+        cheaper to define them all first, then sync them once.
 
-        The view code resembles the following::
-
-            function(doc) {
-                if ('couchable:' in doc) {
-                    var info = doc['couchable:'];
-                    if (info.module == '$module' && info.class == '$cls') {
-                        $emit
-                    }
-                }
-            }
-
-        I{This behavior may change during the course of the 0.x.x series of releases.}
-
-        @type  cls: type
-        @param cls: The class of objects that the view should be restricted to.  Note that sub/superclasses are not considered.
-        @type  name: string
-        @param name: The string to suffix the name of the view with (byclass+module.class:name).
-        @type  keys: list of strings
-        @param keys: A list of unescaped javascript expressions to use as the key for the view.
-        @type  multikeys: list of list of strings
-        @param multikeys: A list of keys (see above).  Each key will get a separate emit.
-        @type  value: string
-        @param value: A string of unescaped javascript used as the value of each emit.
-        @type  reduce: string
-        @param reduce: A CouchDB reduce function.  Can be None, javascript, or the built-in '_sum' kind of reduce function.
         @rtype: str
         @return: The full name of the view (byclass+module.class+name).
         """
-        multikeys = multikeys or [keys]
-        emit_js = '\n'.join(['''emit([{}], {});'''.format(', '.join([('info.private.' + key if key[0] == '_' else 'doc.' + key) for key in keys]), value) for keys in multikeys])
+        fullName = defineClassView(cls, name, keys, multikeys, value, reduce, designDoc, subclasses, linked)
 
-        byclass_js = '''
-            function(doc) {
-                if ('couchable:' in doc) {
-                    var info = doc['couchable:'];
-                    if (info.module == '$module' && info.class == '$cls') {
-                        $emit
-                    }
-                }
-            }'''
+        self.syncViews([designDoc])
 
-        byclass_js = string.Template(byclass_js).safe_substitute(module=cls.__module__, cls=cls.__name__, emit=emit_js, value=value)
+        return fullName
 
-        fullName = 'byclass-{}-{}--{}'.format(cls.__module__, cls.__name__, name)
-        couchdb.design.ViewDefinition('couchable', fullName, byclass_js, reduce).sync(self.db)
+    def syncViews(self, designDocs=None):
+        """
+        Makes sure that the views made by L{defineClassView} are in the
+        database.  Each design doc is fetched once, and the ones that need
+        changes are all written in a single bulk request; design docs that
+        haven't changed aren't written (which would make CouchDB rebuild
+        every view in them).
+
+        A hash of each design doc's views is remembered per database, so
+        syncing again (say, from every new CouchableDb) is free unless
+        more views have been defined since.  Design docs that conflict (say,
+        with another process syncing at the same time) are fetched and
+        written again, a few times before giving up and raising.
+
+        @type  designDocs: list of str
+        @param designDocs: Only sync these design docs.  Defaults to all of them.
+        @rtype: list
+        @return: The names of the design docs that were checked against the database.
+        """
+        design_dict = collections.OrderedDict()
+        for (design, fullName), view_tup in _classView_dict.items():
+            if designDocs is None or design in designDocs:
+                design_dict.setdefault(design, []).append((fullName,) + view_tup)
 
-        return fullName
+        todo_list = []
+        for design, view_list in design_dict.items():
+            view_hash = hashlib.sha1(repr(sorted(view_list))).hexdigest()
+            cache_key = (self.url, design)
+
+            if _syncedView_dict.get(cache_key) != view_hash:
+                todo_list.append((cache_key, view_hash, design, view_list))
+
+        if todo_list:
+            import couchdb.design
+
+            if _trace_api.on:
+                _trace_api('CouchableDb.syncViews() syncing: {!r}', [todo_tup[2] for todo_tup in todo_list])
+
+            retry_list = todo_list
+            for attempt in range(_syncViews_attempts):
+                viewDef_list = [couchdb.design.ViewDefinition(design, fullName, map_js, reduce_js)
+                        for cache_key, view_hash, design, view_list in retry_list
+                        for fullName, map_js, reduce_js in view_list]
+
+                # Only the design docs that needed changes are in the results.
+                error_dict = {}
+                for success, _id, e in couchdb.design.ViewDefinition.sync_many(self.db, viewDef_list):
+                    if not success:
+                        if not isinstance(e, couchdb.http.ResourceConflict):
+                            raise e
+                        error_dict[_id] = e
+
+                for cache_key, view_hash, design, view_list in retry_list:
+                    if '_design/' + design not in error_dict:
+                        _syncedView_dict[cache_key] = view_hash
+
+                retry_list = [todo_tup for todo_tup in retry_list if '_design/' + todo_tup[2] in error_dict]
+                if not retry_list:
+                    break
+
+                log_internal.warn("Conflict syncing views, retrying: {!r}".format(sorted(error_dict)))
+            else:
+                raise error_dict.values()[0]
+
+        return [todo_tup[2] for todo_tup in todo_list]
 
     ##@deprecated
     #def loadInstances(self, cls):
@@ -324,11 +818,41 @@ class CouchableDb(object):
 
     @property
     def db(self):
+        # Connections can't be shared with the parent process after a fork.
         if self._db_pid != os.getpid():
-            self.db = couchdb.Database(self.url)
+            self.db = couchdb.Database(self.url, session=_getSession(self.server_url, *self._session_args))
+            self.server = couchdb.Server(self.server_url, session=self._db.resource.session)
+
+        if not self._db_exists:
+            self._checkDb(self.url in _existingDb_set)
 
         return self._db
 
+    def _checkDb(self, known=False):
+        """
+        Makes sure that the database exists, creating it if need be.  If
+        C{known} is True, this process has already seen it exist, so no
+        requests are made.
+        """
+        if not known:
+            try:
+                self._db.resource.head()
+            except couchdb.http.ResourceNotFound:
+                try:
+                    self._db.resource.put_json()
+
+                    # Any views synced to an earlier incarnation are gone.
+                    for cache_key in list(_syncedView_dict):
+                        if cache_key[0] == self.url:
+                            del _syncedView_dict[cache_key]
+                except couchdb.http.PreconditionFailed:
+                    # Somebody else created it in the meantime.
+                    pass
+
+            _existingDb_set.add(self.url)
+
+        self._db_exists = True
+
     @db.setter
     def db(self, value):
         self._db_pid = os.getpid()
@@ -352,16 +876,81 @@ class CouchableDb(object):
     #    inst = cls.__new__(cls)
     #    inst.__dict__.update({copy.deepcopy(k): copy.deepcopy(v) for k,v in self.__dict__.items if k not in ['_cdb']})
 
-    def storeRetryUpdate(self, update_func, what, skip=None, additiveOnly=False):
-        while True:
-            try:
-                update_func(what)
+    def storeRetryUpdate(self, update_func, what, skip=None, additiveOnly=False, maxRetries=None, baseDelay=0.01, maxDelay=1.0):
+        """
+        Calls C{update_func(what)} and stores C{what}; any docs that
+        conflict get reloaded (in a single batch, into the same objects),
+        have C{update_func} applied again, and get stored again, until
+        everything has been stored.  The docs that stored fine the first
+        time aren't touched again.
+
+        Between attempts, this sleeps for a random time of up to
+        C{baseDelay * 2 ** attempt} seconds, capped at C{maxDelay}.  The
+        number of conflicts, retries and seconds spent waiting are added up
+        in C{cdb.retryStats}.
+
+        @type  update_func: callable
+        @param update_func: Makes the changes to be stored.  Gets called with a list if C{what} is a list (holding just the conflicted objects on retries), otherwise with the object.
+        @type  what: obj or list
+        @param what: The object or list of objects to update and store.
+        @type  maxRetries: int
+        @param maxRetries: Give up and raise the conflict after this many retries.  Defaults to None (keep trying).
+        @type  baseDelay: float
+        @param baseDelay: The cap on the first backoff, in seconds.
+        @type  maxDelay: float
+        @param maxDelay: The cap on any backoff, in seconds.
+        @rtype: str or list
+        @return: The same as L{store}.
+        """
+        if not isinstance(what, list):
+            store_list = [what]
+        else:
+            store_list = what
 
-                return self.store(what, skip, additiveOnly)
-            except couchdb.http.ResourceConflict:
-                time.sleep(random.random())
+        todo_list = store_list
+        attempt = 0
+        while True:
+            update_func(todo_list if isinstance(what, list) else todo_list[0])
+
+            error_list = []
+            self._storeList(todo_list, skip, additiveOnly, error_list)
+
+            for obj, e in error_list:
+                if not isinstance(e, couchdb.http.ResourceConflict):
+                    raise e
+            if not error_list:
+                break
+
+            if maxRetries is not None and attempt >= maxRetries:
+                raise error_list[0][1]
+
+            delay = random.random() * min(maxDelay, baseDelay * 2 ** attempt)
+            with self._retryStats_lock:
+                self.retryStats['conflicts'] += len(error_list)
+                self.retryStats['retries'] += 1
+                self.retryStats['waitSeconds'] += delay
+            time.sleep(delay)
+            attempt += 1
+
+            # load() updates the objects in _obj_by_id in place; objects that
+            # weren't stored or loaded through this db before (or were
+            # replaced since) get put there first, so that the caller's
+            # objects end up with the new _rev.  If only the top-level
+            # objects conflicted, only they get retried; a conflict in a
+            # referenced doc means retrying everything.
+            conflict_set = set(id(obj) for obj, e in error_list)
+            if conflict_set <= set(map(id, todo_list)):
+                todo_list = [obj for obj in todo_list if id(obj) in conflict_set]
+
+            with self._obj_by_id_lock:
+                for obj in todo_list:
+                    self._obj_by_id[obj._id] = obj
+            todo_list = self.load([obj._id for obj in todo_list])
 
-                what = self.load(what)
+        if not isinstance(what, list):
+            return what._id
+        else:
+            return [obj._id for obj in store_list]
 
     def store(self, what, skip=None, additiveOnly=False):
         """
@@ -389,63 +978,210 @@ class CouchableDb(object):
 
         I{This behavior may change during the course of the 0.x.x series of releases.}
 
+        Several threads can store (and load) through the same CouchableDb at
+        once; the working state of each call is kept per-thread.
+
         @type  what: obj or list
         @param what: The object or list of objects to store in CouchDB.
         @rtype: str or list
         @return: The C{._id} of the C{what} parameter, or the list of such IDs if C{what} was a list.
         """
-        if skip is None:
-            self._skip_list = []
-        else:
-            self._skip_list = [x for x in skip if hasattr(x, '_id') and hasattr(x, '_rev')]
-
-        self._additiveOnly = additiveOnly
-
         if not isinstance(what, list):
             store_list = [what]
         else:
             store_list = what
 
+        _refreshTracing()
         if len(store_list) > 3:
-            log_api.info('CouchableDb.store(what={!r}, skip={!r})'.format(store_list[:3] + ['...'], skip))
+            _trace_api('CouchableDb.store(what={!r}, skip={!r})', store_list[:3] + ['...'], skip)
+        else:
+            _trace_api('CouchableDb.store(what={!r}, skip={!r})', what, skip)
+
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            session.add(store_list)
+        elif self._writeBehind is not None:
+            writeBehind = self._writeBehind
+            batchCount = writeBehind.batchCount
+
+            # close() may have been called since self._writeBehind was read.
+            left_list = writeBehind.put(self._packList(store_list, skip, additiveOnly), batchCount)
+            if left_list:
+                self._writeList(left_list)
+        else:
+            self._storeList(store_list, skip, additiveOnly)
+
+        if not isinstance(what, list):
+            return what._id
         else:
-            log_api.info('CouchableDb.store(what={!r}, skip={!r})'.format(what, skip))
+            return [obj._id for obj in store_list]
 
-        self._done_dict = collections.OrderedDict()
-        self._cycle_set = set()
+    def storeIter(self, iterable, skip=None, additiveOnly=False, batchBytes=4*1024*1024):
+        """
+        Stores the objects from C{iterable} (which can be a generator, and
+        can be arbitrarily long) a batch at a time, so that only one batch of
+        packed docs and attachments needs to be held in memory at once.  This
+        is a generator; nothing happens until it's iterated over.
+
+        Referenced docs are stored as with L{store}, but only the first time
+        that they're seen; later objects that refer to a doc that has already
+        been written (possibly in an earlier batch) just refer to its C{_id}.
+
+        If CouchDB refuses to save some of the docs in a batch, the rest of
+        the batch still gets yielded, and then the first error is raised.
+
+        @type  iterable: iterable
+        @param iterable: The objects to store.
+        @type  batchBytes: int
+        @param batchBytes: Roughly how many bytes of JSON and attachments to write per batch.  The JSON size of most docs is estimated from the docs of the same class that have been measured so far.
+        @rtype: generator
+        @return: C{(obj, _id, _rev)} for each doc written, including referenced docs, as each batch completes.
+        """
+        _refreshTracing()
+        _trace_api('CouchableDb.storeIter(iterable={!r}, skip={!r})', iterable, skip)
 
-        for obj in store_list:
-            self._store(obj)
+        # Only referenced docs are remembered, not every object from iterable.
+        written_set = set()
+        todo_list = []
+        todo_set = set()
+        todo_bytes = 0
+
+        # class -> [docs seen, docs measured, bytes measured]
+        size_dict = {}
+        def docBytes(obj, doc):
+            size_list = size_dict.setdefault(type(obj), [0, 0, 0])
+            size_list[0] += 1
+            if size_list[1] < _storeIter_sampleMin or size_list[0] % _storeIter_sampleEvery == 0:
+                size_list[1] += 1
+                size_list[2] += len(couchdb.json.encode(doc))
+            return size_list[2] // size_list[1]
+
+        def flush(todo_list):
+            error_list = []
+            self._writeList(todo_list, error_list)
+
+            error_set = set(id(obj) for obj, e in error_list)
+            for obj, doc, attachment_dict in todo_list:
+                if id(obj) not in error_set:
+                    yield obj, obj._id, obj._rev
+
+            if error_list:
+                raise error_list[0][1]
+
+        for top in iterable:
+            for entry in self._packList([top], skip, additiveOnly, written_set):
+                obj, doc, attachment_dict = entry
+
+                # The same doc can't go out twice in one _bulk_docs request;
+                # it was packed with the _rev from before the flush.
+                if obj._id in todo_set:
+                    for result in flush(todo_list):
+                        yield result
+                    todo_list, todo_set, todo_bytes = [], set(), 0
+
+                    if getattr(obj, '_rev', None) is not None:
+                        doc['_rev'] = obj._rev
+
+                todo_list.append(entry)
+                todo_set.add(obj._id)
+                if obj is not top:
+                    written_set.add(obj._id)
+                todo_bytes += docBytes(obj, doc) + sum(len(content) for content, content_type in attachment_dict.values())
+
+            if todo_bytes >= batchBytes:
+                for result in flush(todo_list):
+                    yield result
+                todo_list, todo_set, todo_bytes = [], set(), 0
+
+        if todo_list:
+            for result in flush(todo_list):
+                yield result
+
+    def _storeList(self, store_list, skip=None, additiveOnly=False, error_list=None):
+        """
+        Does the actual work of L{store}.  If C{error_list} is given, docs
+        that CouchDB refuses to save (conflicts, etc.) get C{(obj, exception)}
+        appended to it instead of raising the first such error.
+        """
+        self._writeList(self._packList(store_list, skip, additiveOnly), error_list)
+
+    def _packList(self, store_list, skip=None, additiveOnly=False, written_set=None):
+        """
+        Packs the objects in C{store_list} (and the docs that they reference)
+        into a list of C{(obj, doc, attachment_dict)} for L{_writeList}.
+        Everything that gets written is copied out of the objects here
+        (including pickles), so the objects are free to change afterwards.
+
+        Referenced docs whose IDs are in C{written_set} are left alone.
+        """
+        with self._storeContext(skip, additiveOnly, written_set) as ctx:
+            for obj in store_list:
+                self._store(obj)
+
+            # Referenced docs get queued by _store rather than packed on the spot,
+            # so long chains of docs don't turn into deep recursion.
+            while ctx.store_deque:
+                obj = ctx.store_deque.popleft()
+
+                attachment_dict = {}
+                doc = {}
+                self._pack_doc(doc, obj, attachment_dict)
+
+                ctx.done_dict[obj._id] = (obj, doc, attachment_dict)
+
+                obj._cdb = self
+
+            todo_list = []
+            for (obj, doc, attachment_dict) in ctx.done_dict.values():
+                if obj not in ctx.skip_list:
+                    if 'pickles' in attachment_dict:
+                        content_tup = attachment_dict['pickles']
+
+                        content = doGzip(doPickle(content_tup))
+                        content_type = 'application/pickle'
+
+                        attachment_dict['pickles'] = (content, content_type)
+
+                    todo_list.append((obj, doc, attachment_dict))
+
+        return todo_list
+
+    def _writeList(self, todo_list, error_list=None):
+        """
+        Saves the output of L{_packList} to CouchDB; small docs go out in one
+        C{_bulk_docs} request, and docs with large attachments go out one at a
+        time as multipart requests.
+        """
+        # Every doc gets written before raising, so that the objects for
+        # the docs that did get saved still get their new _rev.
+        raise_list = []
+        if error_list is None:
+            error_list = raise_list
 
-        todo_list = list(self._done_dict.values())
         mime_list = []
         bulk_list = []
         for (obj, doc, attachment_dict) in todo_list:
-            log_internal.info("TODO: {}".format(doc['_id']))
-            if obj not in self._skip_list:
-                if 'pickles' in attachment_dict:
-                    content_tup = attachment_dict['pickles']
-
-                    content = doGzip(doPickle(content_tup))
-                    content_type = 'application/pickle'
+            if _trace_store.on:
+                _trace_store("TODO: {}", doc['_id'])
 
-                    attachment_dict['pickles'] = (content, content_type)
-
-                total_len = 0
-                for content_name, (content, content_type) in list(attachment_dict.items()):
-                    total_len += len(content)
+            total_len = 0
+            for content_name, (content, content_type) in list(attachment_dict.items()):
+                total_len += len(content)
 
-                # FIXME: use a better cutoff
-                if total_len > self._maxStrLen * 2:
-                    mime_list.append((obj, doc, attachment_dict, total_len))
-                else:
-                    doc['_attachments'] = {content_name: {'content_type': content_type, 'data': base64.b64encode(content)} for content_name, (content, content_type) in attachment_dict.items()}
-                    bulk_list.append((obj, doc))
+            # FIXME: use a better cutoff
+            if total_len > self._maxStrLen * 2:
+                mime_list.append((obj, doc, attachment_dict, total_len))
+            else:
+                doc['_attachments'] = {content_name: {'content_type': content_type, 'data': base64.b64encode(content)} for content_name, (content, content_type) in attachment_dict.items()}
+                bulk_list.append((obj, doc))
 
         #print 'mime', mime_list
         #print 'bulk', bulk_list
 
         mime_list.sort(key=lambda todo_tup: -todo_tup[3])
+        if mime_list:
+            import couchdb.multipart
+
         for (obj, doc, attachment_dict, total_len) in mime_list:
             if '_rev' not in doc:
                 #print 'missing rev', doc['_id'], id(doc)
@@ -475,7 +1211,12 @@ class CouchableDb(object):
 
             http_headers = {'Referer': self.db.resource.url, 'Content-Type': header_str[len('Content-Type: '):]}
             params = {}
-            status, msg, data = self.db.resource.post(doc['_id'], body, http_headers, **params)
+            try:
+                status, msg, data = self.db.resource.post(doc['_id'], body, http_headers, **params)
+            except couchdb.http.ResourceConflict as e:
+                log_internal.warn("Error updating multipart {}: {} @ {}".format(type(obj), doc['_id'], getattr(obj, '_rev', None)))
+                error_list.append((obj, e))
+                continue
 
             if status != 201:
                 log_internal.warn("Error updating multipart, status: {}, msg: {}".format(staus, msg))
@@ -494,11 +1235,15 @@ class CouchableDb(object):
             if hasattr(obj, '_couchableMultipartPending'):
                 del obj._couchableMultipartPending
 
-            self._obj_by_id[obj._id] = obj
+            with self._obj_by_id_lock:
+                self._obj_by_id[obj._id] = obj
+
+        if self._patchUpdates and bulk_list:
+            bulk_list = self._writePatches(bulk_list)
 
         #print 'hitting bulk docs:', [x for x in [str(bulk_tup[1].get('_id', None)) for bulk_tup in bulk_list] if 'CoordinateSystem' not in x]
         try:
-            ret_list = self.db.update([bulk_tup[1] for bulk_tup in bulk_list])
+            ret_list = self.db.update([bulk_tup[1] for bulk_tup in bulk_list]) if bulk_list else []
         except UnicodeDecodeError as e:
             for bulk_obj, bulk_doc in bulk_list:
                 for s in findBadJson(bulk_doc, bulk_obj._id):
@@ -510,32 +1255,227 @@ class CouchableDb(object):
             if not success:
                 log_internal.warn("Error updating {}: {} @ {}".format(type(obj), _id, getattr(obj, '_rev', None)))
                 #log_internal.warn("Error updating {}: {} > {}".format(type(obj), _id, vars(_rev)))
-                raise _rev
+                error_list.append((obj, _rev))
             else:
                 obj._rev = _rev
-                self._obj_by_id[obj._id] = obj
+                with self._obj_by_id_lock:
+                    self._obj_by_id[obj._id] = obj
+
+                if self._patchUpdates:
+                    self._rememberDoc(doc, _rev)
                 #print "self._obj_by_id[obj._id] = obj", self._obj_by_id.items()
                 #log_internal.error("self._obj_by_id[obj._id] = obj")
         #log_internal.error("outside for")
         #print "outside for", self._obj_by_id.items(), store_list
 
-        del self._done_dict
-        del self._cycle_set
-        del self._skip_list
-        del self._additiveOnly
+        if raise_list:
+            raise raise_list[0][1]
 
-        if not isinstance(what, list):
-            return what._id
-        else:
-            return [obj._id for obj in store_list]
+    def _rememberDoc(self, doc, _rev, doc_len=None):
+        """
+        Keeps C{doc} as the last known version of its document, for
+        L{_writePatches}.  Small docs and docs with attachments are never
+        patched, so they aren't kept.  The least recently kept docs are
+        dropped once the encoded sizes of the kept ones add up to more than
+        C{_patchCacheBytes}.
+        """
+        if not doc.get('_attachments') and doc_len is None:
+            doc_len = len(couchdb.json.encode(doc))
+
+        with self._packed_lock:
+            old_tup = self._packed_dict.pop(doc['_id'], None)
+            if old_tup is not None:
+                self._packed_bytes -= old_tup[2]
+
+            if not doc.get('_attachments') and doc_len >= _patchMinLen:
+                self._packed_dict[doc['_id']] = (_rev, doc, doc_len)
+                self._packed_bytes += doc_len
+
+                while self._packed_bytes > _patchCacheBytes:
+                    self._packed_bytes -= self._packed_dict.popitem(False)[1][2]
+
+    def _writePatches(self, bulk_list):
+        """
+        Sends the changes to large docs that have only changed a little since
+        they were last stored or loaded through the C{patch} update handler
+        in the C{couchable} design doc, rather than the whole doc.  Returns
+        the C{(obj, doc)} items that still need to be written in full: small
+        docs, docs with attachments, docs this CouchableDb hasn't seen at
+        their current C{_rev}, docs with large changes, and docs whose patch
+        failed (say, because of a conflict; the full write then fails the
+        usual way).
+        """
+        todo_list = []
+        for obj, doc in bulk_list:
+            if doc.get('_attachments') or '_rev' not in doc:
+                todo_list.append((obj, doc))
+                continue
+
+            with self._packed_lock:
+                old_tup = self._packed_dict.get(doc['_id'])
+
+            if old_tup is None or old_tup[0] != doc['_rev']:
+                todo_list.append((obj, doc))
+                continue
+
+            doc_len = len(couchdb.json.encode(doc))
+            if doc_len < _patchMinLen:
+                todo_list.append((obj, doc))
+                continue
+
+            set_list, unset_list = _docPatch(old_tup[1], doc)
+            patch_json = couchdb.json.encode({'rev': doc['_rev'], 'set': set_list, 'unset': unset_list})
+            if len(patch_json) * 4 > doc_len:
+                todo_list.append((obj, doc))
+                continue
+
+            try:
+                self._checkPatchHandler()
+                headers, body = self.db.update_doc('couchable/patch', doc['_id'], body=patch_json, headers={'Content-Type': 'application/json'})
+                body.read()
+                _rev = headers.get('X-Couch-Update-NewRev')
+            except couchdb.http.HTTPError, e:
+                log_internal.warn("Error patching {}: {!r}".format(doc['_id'], e))
+                _rev = None
+
+            if _rev is None:
+                todo_list.append((obj, doc))
+                continue
+
+            if _trace_store.on:
+                _trace_store("Patched {}: {} bytes instead of {}", doc['_id'], len(patch_json), doc_len)
+
+            obj._rev = _rev
+            with self._obj_by_id_lock:
+                self._obj_by_id[obj._id] = obj
+            self._rememberDoc(doc, _rev, doc_len)
+
+        return todo_list
+
+    def _checkPatchHandler(self):
+        """
+        Makes sure that the C{patch} update handler is in the C{couchable}
+        design doc (once per database per process, like L{syncViews}).
+        """
+        cache_key = (self.url, 'updates/patch')
+        if _syncedView_dict.get(cache_key) == _patch_js:
+            return
+
+        doc = self.db.get('_design/couchable', {'_id': '_design/couchable'})
+        if doc.get('updates', {}).get('patch') != _patch_js:
+            doc.setdefault('updates', {})['patch'] = _patch_js
+
+            # Update handlers aren't part of the view index, so this doesn't
+            # make CouchDB rebuild the views in the design doc.
+            self.db.save(doc)
+
+        _syncedView_dict[cache_key] = _patch_js
+
+    def startWriteBehind(self, maxsize=1000, batchSize=100, errback=None):
+        """
+        Switches L{store} to write-behind mode: objects still get packed
+        right away (so later changes to them don't leak into what gets
+        written), but the packed docs are handed to a background thread
+        that writes them out in batches, and store returns without waiting
+        on CouchDB.  Storing an C{_id} that's still waiting to be written
+        replaces the older version in the queue.
+
+        Call L{flush} to wait for everything queued so far to be written,
+        and L{close} to go back to normal stores.  Anything still queued
+        when the process exits without a L{close} is lost.
+
+        @type  maxsize: int
+        @param maxsize: The most docs to queue up; store blocks while the queue is full.
+        @type  batchSize: int
+        @param batchSize: The most docs to write per request.
+        @type  errback: callable
+        @param errback: Called from the background thread as C{errback(obj, exception)} for each doc that can't be written.  Defaults to logging the error.
+        """
+        assert self._writeBehind is None, "Write-behind is already on"
+
+        self._writeBehind = _WriteBehind(self, maxsize, batchSize, errback)
+
+    def flush(self):
+        """
+        Waits until every doc queued by a write-behind L{store} has been
+        written (or failed).  Does nothing if write-behind is off.
+        """
+        if self._writeBehind is not None:
+            self._writeBehind.flush()
+
+    def close(self):
+        """
+        Flushes and stops write-behind mode (see L{startWriteBehind}).
+        """
+        writeBehind, self._writeBehind = self._writeBehind, None
+        if writeBehind is not None:
+            writeBehind.close()
+
+    def session(self, skip=None, additiveOnly=False):
+        """
+        Returns a context manager that batches up every L{store} call made
+        (in this thread) inside of the C{with} block into a single store
+        when the block exits::
+
+            with cdb.session() as session:
+                cdb.store(a)
+                cdb.store([b, c])
+                cdb.store(a)
+
+        The objects are only packed once each (by C{_id}), and everything
+        goes out in one C{_bulk_docs} request.  L{store} calls made inside
+        the session get an C{_id} assigned right away, so they can still
+        return it, but their C{skip} and C{additiveOnly} arguments are
+        ignored in favor of the session's.
+
+        Nothing is stored if the block raises.  Otherwise any docs that
+        couldn't be saved end up in C{session.conflict_list} as
+        C{(obj, exception)} tuples, and a L{StoreConflictException} is
+        raised once all of the others have been saved.  Nested sessions
+        are folded into the outermost one.
+
+        @type  skip: list
+        @param skip: Passed along to the L{store} done on exit.
+        @type  additiveOnly: bool
+        @param additiveOnly: Passed along to the L{store} done on exit.
+        @rtype: L{StoreSession}
+        """
+        return StoreSession(self, skip, additiveOnly)
+
+
+    @property
+    def _ctx(self):
+        """
+        The L{_StoreContext} of the store call currently running in this
+        thread.
+        """
+        return self._local.ctx_list[-1]
+
+    @contextlib.contextmanager
+    def _storeContext(self, skip=None, additiveOnly=False, written_set=None):
+        """
+        Pushes a fresh L{_StoreContext} for the current thread, and pops it
+        again once the C{with} block is done.
+        """
+        ctx_list = self._local.__dict__.setdefault('ctx_list', [])
+        ctx = _StoreContext(skip, additiveOnly, written_set)
 
+        ctx_list.append(ctx)
+        try:
+            yield ctx
+        finally:
+            ctx_list.pop()
 
     def _store(self, obj):
-        log_internal.debug("_store {}: {} @ {}".format(type(obj), getattr(obj, '_id', None), getattr(obj, '_rev', None)))
+        if _trace_store.on:
+            _trace_store("_store {}: {} @ {}", type(obj), getattr(obj, '_id', None), getattr(obj, '_rev', None))
 
         if isinstance(obj, (CouchableDb, couchdb.client.Server, couchdb.client.Database)):
             raise UncouchableException("Illegal to attempt to store objects of type", type(obj), obj)
 
+        if getattr(obj, '_couchablePartial', None) is not None:
+            raise UncouchableException("Illegal to attempt to store partially loaded objects (see load's fields argument)", type(obj), obj)
+
         base_cls, func_tuple = findHandler(type(obj), _couchable_types)
         if func_tuple:
             func_tuple[0](obj, self)
@@ -544,101 +1484,243 @@ class CouchableDb(object):
             newid(obj)
             assert obj._id not in self._obj_by_id
 
-        if obj._id not in self._done_dict:
-            self._done_dict[obj._id] = (obj, {}, {})
+        ctx = self._ctx
+        if obj._id not in ctx.done_dict:
+            ctx.done_dict[obj._id] = (obj, {}, {})
+            ctx.store_deque.append(obj)
+
+    def _pack_doc(self, doc, obj, attachment_dict):
+        """
+        Packs a top-level document object into C{doc}.  Underscore attributes
+        (other than C{_id} and C{_rev}) end up in C{doc['couchable:']['private']}.
+        """
+        ctx = self._ctx
 
-            attachment_dict = {}
+        # Shared references only ever point within the same document.
+        ctx.ref_dict = {}
 
-            doc = {}
+        if isinstance(obj, (dict, list)) or not hasattr(obj, '__dict__') or findHandler(type(obj), _pack_handlers)[1] is not _walked_handler_tuple[0]:
             self._pack_object(doc, obj, attachment_dict, 'self', False, True)
+            return doc
 
-            #if 'pickles' in doc[FIELD_NAME]:
-            #    doc[FIELD_NAME]['pickles'] = pickle.dumps(doc[FIELD_NAME]['pickles'])
+        if _trace_pack.on:
+            _trace_pack("{}: {} @ {}, {}", type(obj), getattr(obj, '_id', None), getattr(obj, '_rev', None), 'self')
 
-            self._done_dict[obj._id] = (obj, doc, attachment_dict)
+        stack = []
+        self._pack_enter(ctx.cycle_set, stack, obj, 'self')
+        self._objInfo_doc(obj, doc, self._classHierarchy)
 
-            obj._cdb = self
+        if self._shareRefs:
+            ctx.ref_dict[id(obj)] = (obj, doc, 0)
 
+        private_doc = {}
+        for k, v in obj.__dict__.items():
+            if k not in _skip_key_set:
+                if isinstance(k, basestring) and k.startswith('_') and k not in ('_id', '_rev'):
+                    packed = doc[FIELD_NAME]['private'] = private_doc
+                else:
+                    packed = doc
 
+                stack.append((packed, self._pack(doc, k, attachment_dict, _PathName('self', '{}>{!s}', k), True), v, 'self', '{}.{!s}', k))
 
+        stack.reverse()
+        self._pack_iter(doc, stack, attachment_dict)
 
-    def _pack(self, parent_doc, data, attachment_dict, name, isKey=False):
-        cls = type(data)
+        return doc
 
-        base_cls, handler = findHandler(cls, _pack_handlers)
+    def _pack(self, parent_doc, data, attachment_dict, name, isKey=False):
+        """
+        Packs C{data} into something that can be JSON encoded.  Lists, dicts
+        and plain objects are walked with an explicit stack (see
+        L{_pack_iter}), so deeply nested data doesn't hit the recursion limit.
+        """
+        if isKey:
+            cls = type(data)
+            base_cls, handler = findHandler(cls, _pack_handlers)
 
-        #if '_pack_native' not in repr(handler):
-        #    log_internal.debug("_pack {}: {} @ {}, {} {}".format(type(data), getattr(data, '_id', None), getattr(data, '_rev', None), base_cls, handler))
+            try:
+                return handler(self, parent_doc, data, attachment_dict, name, isKey)
+            except Exception, e:
+                log_internal.error('{}, {} in base_cls {}, handler {} isKey: {}'.format(name, cls, base_cls, handler, isKey))
+                raise
 
-        try:
-            #print "Calling _pack: {}".format((data, attachment_dict, name))
-            #print ''.join(traceback.format_stack())
-            return handler(self, parent_doc, data, attachment_dict, name, isKey)
-        #except RuntimeError:
-        #    log_internal.error(name)
-        #    raise
-        except Exception, e:
-            log_internal.error('{}, {} in base_cls {}, handler {} isKey: {}'.format(name, cls, base_cls, handler, isKey))
-            raise
-        #finally:
-        #    log_internal.debug("_pack finished {}: {} @ {}".format(type(data), getattr(data, '_id', None), getattr(data, '_rev', None)))
+        packed = [None]
+        self._pack_iter(parent_doc, [(packed, 0, data, name, None, None)], attachment_dict)
 
+        return packed[0]
 
-        #if handler:
-        #    try:
-        #        return handler(self, parent_doc, data, attachment_dict, name, isKey)
-        #    except RuntimeError:
-        #        print "Error with", cls, data
-        #        raise
-        #else:
-        #    raise UncouchableException("No _packer for type", cls, data)
-
-        #if cls in _pack_handlers:
-        #    return _pack_handlers[cls](self, parent_doc, data, attachment_dict, name, isKey)
-        #else:
-        #    for types, func in reversed(_pack_handlers.items()):
-        #        if isinstance(data, types):
-        #            return func(self, parent_doc, data, attachment_dict, name, isKey)
-        #            break
-        #    else:
-        #        raise UncouchableException("No _packer for type", cls, data)
-
-    def _objInfo_doc(self, data, doc):
+    def _pack_enter(self, cycle_set, stack, data, name):
         """
-        >>> cdb=CouchableDb('testing')
-        >>> obj = object()
-        >>> pprint.pprint(cdb._objInfo_doc(obj, {}))
-        {'couchable:': {'class': 'object', 'module': '__builtin__', 'pid': ..., 'time': ...}}
+        Cycle check for containers being walked by L{_pack_iter}; the exit
+        marker pushed here removes C{data} from C{_cycle_set} once all of its
+        children have been popped off of the stack.
         """
-        cls = type(data)
-        doc.setdefault(FIELD_NAME, {})
-        doc[FIELD_NAME]['class'] = cls.__name__
-        doc[FIELD_NAME]['pid'] = os.getpid()
-        doc[FIELD_NAME]['time'] = time.time()
+        if id(data) in cycle_set:
+            raise ValueError("Object {} is cycle root: {!r}, {}".format(id(data), name, type(data)))
 
-        if hasattr(cls, '__module__'):
-            doc[FIELD_NAME]['module'] = str(cls.__module__)
+        cycle_set.add(id(data))
+        stack.append((None, None, id(data), None, None, None))
+
+    def _pack_iter(self, parent_doc, stack, attachment_dict):
+        """
+        Pops C{(packed, slot, data, parent_name, format_str, key)} items off
+        of C{stack} and stores the packed form of C{data} in C{packed[slot]}
+        until the stack is empty.
+
+        Lists, dicts and plain objects get an empty container put into their
+        slot, and their children get pushed onto the stack.  Everything else
+        is handed to the type's handler from C{_pack_handlers}.  Names are
+        kept as (parent, format, key) parts and only turned into a
+        L{_PathName} when something might need them.
+        """
+        ctx = self._ctx
+        cycle_set = ctx.cycle_set
+        object_handler, native_handler, list_handler, dict_handler = _walked_handler_tuple
+        handler_get = _pack_handlers.get
+        item = cls = handler = None
 
         try:
-            if cls not in self._cls2srcMd5sum_dict:
-                self._cls2srcMd5sum_dict[cls] = hashlib.md5(inspect.getsource(cls)).hexdigest()
+            while stack:
+                item = packed, slot, data, name, format_str, key = stack.pop()
 
-            doc[FIELD_NAME]['src_md5'] = self._cls2srcMd5sum_dict[cls]
-        except (IOError, TypeError):
-            pass
+                if packed is None:
+                    cycle_set.remove(data)
+                    continue
 
-        return doc
+                cls = type(data)
+                handler = handler_get(cls) or findHandler(cls, _pack_handlers)[1]
 
-    def _objInfo_consargs(self, data, doc, args=None, kwargs=None):
-        """
-        >>> cdb=CouchableDb('testing')
-        >>> obj = tuple([1, 2, 3])
-        >>> pprint.pprint(cdb._objInfo_consargs(obj, {}, list(obj), {}))
-        {'couchable:': {'args': [1, 2, 3],
-                        'class': 'tuple',
-                        'kwargs': {},
-                        'module': '__builtin__',
-                        'pid': ...,
+                if handler is native_handler:
+                    packed[slot] = data
+                    continue
+
+                if format_str is not None:
+                    name = _PathName(name, format_str, key)
+
+                if handler is list_handler and cls is list:
+                    kind = self._listKind(data)
+                    if kind is None:
+                        self._pack_enter(cycle_set, stack, data, name)
+                        packed[slot] = self._push_list(stack, data, name)
+                    else:
+                        packed[slot] = self._pack_listKind(parent_doc, data, attachment_dict, name, kind)
+
+                elif handler is dict_handler and cls is dict:
+                    self._pack_enter(cycle_set, stack, data, name)
+                    packed[slot] = self._push_dict(stack, parent_doc, {}, data, attachment_dict, name, False)
+
+                elif handler is object_handler and hasattr(data, '__dict__') and not isinstance(data, (dict, list)) \
+                        and findHandler(cls, _couchable_types)[0] is None:
+                    if self._shareRefs:
+                        ref_tuple = ctx.ref_dict.get(id(data))
+                        if ref_tuple is not None:
+                            packed[slot] = self._pack_ref(ref_tuple)
+                            continue
+
+                    if _trace_pack.on:
+                        _trace_pack("{}: {} @ {}, {}", cls, getattr(data, '_id', None), getattr(data, '_rev', None), name)
+
+                    self._pack_enter(cycle_set, stack, data, name)
+                    obj_doc = self._objInfo_doc(data, {})
+
+                    if self._shareRefs:
+                        ctx.ref_dict[id(data)] = (data, obj_doc, len(ctx.ref_dict))
+
+                    packed[slot] = self._push_dict(stack, parent_doc, obj_doc, data.__dict__, attachment_dict, name, True)
+
+                else:
+                    packed[slot] = handler(self, parent_doc, data, attachment_dict, name, False)
+
+        except Exception, e:
+            packed, slot, data, name, format_str, key = item or (None,) * 6
+            if format_str is not None:
+                name = _PathName(name, format_str, key)
+
+            log_internal.error('{}, {} in base_cls {}, handler {} isKey: {}'.format(name, cls, findHandler(cls, _pack_handlers)[0], handler, False))
+
+            for item in stack:
+                if item[0] is None:
+                    cycle_set.discard(item[2])
+
+            raise
+
+    def _pack_ref(self, ref_tuple):
+        """
+        Returns a back-reference to an object that has already been packed
+        into the current document, tagging the first occurrence with its
+        local ref id (only objects that are actually shared get tagged).
+        """
+        data, obj_doc, ref = ref_tuple
+        obj_doc[FIELD_NAME]['ref'] = ref
+
+        return '{}{}:{}'.format(FIELD_NAME, 'ref', ref)
+
+    def _push_list(self, stack, data, name):
+        packed = [None] * len(data)
+        for i in xrange(len(data) - 1, -1, -1):
+            stack.append((packed, i, data[i], name, '{}[{}]', i))
+
+        return packed
+
+    def _push_dict(self, stack, parent_doc, packed, data, attachment_dict, name, isObjDict):
+        if isObjDict:
+            key_str = '{}>{!s}'
+            value_str = '{}.{!s}'
+        else:
+            key_str = '{}>{!r}'
+            value_str = '{}[{!r}]'
+
+        for k, v in reversed(data.items()):
+            if k not in _skip_key_set:
+                handler = findHandler(type(k), _pack_handlers)[1]
+                stack.append((packed, handler(self, parent_doc, k, attachment_dict, _PathName(name, key_str, k), True), v, name, value_str, k))
+
+        return packed
+
+    def _objInfo_doc(self, data, doc, mro=False):
+        """
+        If C{mro} is True, the C{module.class} names of the class's bases
+        (in method resolution order, leaving out C{object}) are recorded too.
+
+        >>> cdb=CouchableDb('testing')
+        >>> obj = object()
+        >>> pprint.pprint(cdb._objInfo_doc(obj, {}))
+        {'couchable:': {'class': 'object', 'module': '__builtin__', 'pid': ..., 'time': ...}}
+        >>> pprint.pprint(cdb._objInfo_doc(UncouchableException('', None, None), {}, True)['couchable:']['mro'])
+        ['exceptions.Exception', 'exceptions.BaseException']
+        """
+        cls = type(data)
+        doc.setdefault(FIELD_NAME, {})
+        doc[FIELD_NAME]['class'] = cls.__name__
+        doc[FIELD_NAME]['pid'] = os.getpid()
+        doc[FIELD_NAME]['time'] = time.time()
+
+        if hasattr(cls, '__module__'):
+            doc[FIELD_NAME]['module'] = str(cls.__module__)
+
+        if mro:
+            doc[FIELD_NAME]['mro'] = ['{}.{}'.format(base.__module__, base.__name__) for base in inspect.getmro(cls)[1:] if base is not object]
+
+        try:
+            if cls not in self._cls2srcMd5sum_dict:
+                self._cls2srcMd5sum_dict[cls] = hashlib.md5(inspect.getsource(cls)).hexdigest()
+
+            doc[FIELD_NAME]['src_md5'] = self._cls2srcMd5sum_dict[cls]
+        except (IOError, TypeError):
+            pass
+
+        return doc
+
+    def _objInfo_consargs(self, data, doc, args=None, kwargs=None):
+        """
+        >>> cdb=CouchableDb('testing')
+        >>> obj = tuple([1, 2, 3])
+        >>> pprint.pprint(cdb._objInfo_consargs(obj, {}, list(obj), {}))
+        {'couchable:': {'args': [1, 2, 3],
+                        'class': 'tuple',
+                        'kwargs': {},
+                        'module': '__builtin__',
+                        'pid': ...,
                         'time': ...}
         """
         doc = self._objInfo_doc(data, doc)
@@ -685,7 +1767,8 @@ class CouchableDb(object):
                 'kwargs': {},
                 'module': '__builtin__'}}}}}
         """
-        log_internal.info("{}: {} @ {}, {}".format(type(data), getattr(data, '_id', None), getattr(data, '_rev', None), name))
+        if _trace_pack.on:
+            _trace_pack("{}: {} @ {}, {}", type(data), getattr(data, '_id', None), getattr(data, '_rev', None), name)
         assert not (isKey and topLevel)
 
         cls = type(data)
@@ -693,12 +1776,14 @@ class CouchableDb(object):
 
         # Means this needs to be a new top-level document.
         if base_cls and not topLevel:
-            if self._additiveOnly \
+            if self._ctx.additiveOnly \
                     and getattr(data, '_id', None) is not None \
                     and getattr(data, '_rev', None) is not None \
                     and getattr(data, '_couchableMultipartPending', None) is None:
                 pass
-            elif data not in self._skip_list:
+            elif getattr(data, '_id', None) in self._ctx.written_set:
+                pass
+            elif data not in self._ctx.skip_list:
                 self._store(data)
 
             return '{}{}:{}'.format(FIELD_NAME, 'id', data._id)
@@ -723,7 +1808,7 @@ class CouchableDb(object):
         else:
             doc = {}
 
-        self._objInfo_doc(data, doc)
+        self._objInfo_doc(data, doc, topLevel and self._classHierarchy)
         update_dict = self._pack_dict_keyMeansObject(parent_doc, data.__dict__, attachment_dict, name, True, topLevel)
 
         assert set(doc).intersection(set(update_dict)) == set(), repr(set(doc).intersection(set(update_dict)))
@@ -791,7 +1876,7 @@ class CouchableDb(object):
 
         if isinstance(data, str):
             try:
-                data.decode('utf8')
+                codecs.utf_8_decode(data, 'strict', True)
                 # This means that it's either clean ascii, or encoded as utf8,
                 # as god intended.  We can work with it.
             except:
@@ -922,7 +2007,162 @@ class CouchableDb(object):
 
             return self._pack_object(parent_doc, data, attachment_dict, name, isKey)
 
-        return [self._pack(parent_doc, x, attachment_dict, '{}[{}]'.format(name, i), False) for i, x in enumerate(data)]
+        kind = self._listKind(data)
+        if kind is not None:
+            return self._pack_listKind(parent_doc, data, attachment_dict, name, kind)
+
+        stack = []
+        packed = self._push_list(stack, data, name)
+        self._pack_iter(parent_doc, stack, attachment_dict)
+
+        return packed
+
+    def _listKind(self, data):
+        """
+        Classifies a list once per pack: C{'columnar'} (see L{_isColumnar}),
+        an C{array.array} typecode (see L{_arrayTypecode}), or None for a
+        plain list.
+
+        >>> cdb=CouchableDb('testing', arrayMinLen=3)
+        >>> cdb._listKind([1.0, 2.5, 3.0])
+        'd'
+        >>> cdb._listKind([1, 'a', 3])
+        """
+        if self._isColumnar(data):
+            return 'columnar'
+
+        return self._arrayTypecode(data)
+
+    def _pack_listKind(self, parent_doc, data, attachment_dict, name, kind):
+        """
+        Packs a list that L{_listKind} classified as C{kind}.
+        """
+        if kind == 'columnar':
+            return self._pack_columnar(parent_doc, data, attachment_dict, name)
+
+        return self._pack_array(parent_doc, data, attachment_dict, name, kind)
+
+    def _isColumnar(self, data):
+        """
+        Columnar lists must be long enough, and made up of plain (non-doc,
+        non-attachment, etc.) objects that all share a class and key set.
+
+        >>> cdb=CouchableDb('testing', columnarMinLen=2)
+        >>> class Foo(object):
+        ...     def __init__(self, **kwargs):
+        ...         self.__dict__.update(kwargs)
+        ...
+        >>> cdb._isColumnar([Foo(a=1), Foo(a=2)])
+        True
+        >>> cdb._isColumnar([Foo(a=1)])
+        False
+        >>> cdb._isColumnar([Foo(a=1), Foo(b=2)])
+        False
+        >>> cdb._isColumnar([Foo(a=1), 2])
+        False
+        """
+        if self._columnarMinLen is None or len(data) < self._columnarMinLen:
+            return False
+
+        cls = type(data[0])
+        if findHandler(cls, _pack_handlers)[0] is not object or findHandler(cls, _couchable_types)[0] is not None:
+            return False
+
+        keys = getattr(data[0], '__dict__', None)
+        if keys is None or not all(isinstance(k, basestring) for k in keys):
+            return False
+        keys = keys.viewkeys()
+
+        return all(type(x) is cls and x.__dict__.viewkeys() == keys for x in data)
+
+    def _pack_columnar(self, parent_doc, data, attachment_dict, name):
+        """
+        Packs a list that passed L{_isColumnar} as a single object-like dict,
+        with the class info stored once and each attribute holding a list of
+        the packed values (one per element)::
+
+            {'couchable:': {'class': 'Foo', 'module': '...', 'columnar': 2},
+             'a': [1, 2],
+             'b': ['x', 'y']}
+        """
+        doc = self._objInfo_doc(data[0], {})
+        doc[FIELD_NAME]['columnar'] = len(data)
+
+        key_list = [k for k in data[0].__dict__ if k not in _skip_key_set]
+        column_list = [[] for k in key_list]
+        cycle_set = self._ctx.cycle_set
+
+        for i, x in enumerate(data):
+            # Mirrors the cycle check that _pack_dict_keyMeansObject would do on x.__dict__.
+            if id(x.__dict__) in cycle_set:
+                raise ValueError("Object {} is cycle root: {!r}, {}".format(id(x.__dict__), name, type(x.__dict__)))
+
+            try:
+                cycle_set.add(id(x.__dict__))
+                for k, column in itertools.izip(key_list, column_list):
+                    column.append(self._pack(parent_doc, x.__dict__[k], attachment_dict, _PathName(_PathName(name, '{}[{}]', i), '{}.{!s}', k), False))
+            finally:
+                cycle_set.remove(id(x.__dict__))
+
+        for k, column in itertools.izip(key_list, column_list):
+            doc[self._pack(parent_doc, k, attachment_dict, _PathName(name, '{}>{!s}', k), True)] = column
+
+        return doc
+
+    def _arrayTypecode(self, data):
+        """
+        Returns the C{array.array} typecode that can hold every element of the
+        list losslessly, or None if the list shouldn't be stored as an array.
+
+        >>> cdb=CouchableDb('testing', arrayMinLen=3)
+        >>> cdb._arrayTypecode([1.0, 2.5, 3.0])
+        'd'
+        >>> cdb._arrayTypecode([1, 2, 3])
+        'i'
+        >>> cdb._arrayTypecode([1, 2, 2**40])
+        >>> cdb._arrayTypecode([1, 2.0, 3])
+        >>> cdb._arrayTypecode([True, False, True])
+        >>> cdb._arrayTypecode([1.0, 2.0])
+        """
+        if self._arrayMinLen is None or len(data) < self._arrayMinLen:
+            return None
+
+        type_set = set(itertools.imap(type, data))
+        if type_set == set([float]):
+            return 'd'
+        elif type_set == set([int]) and -2**31 <= min(data) and max(data) < 2**31:
+            return 'i'
+
+        return None
+
+    def _pack_array(self, parent_doc, data, attachment_dict, name, typecode):
+        """
+        Stores the list as gzipped little-endian C{array.array} bytes.  Small
+        results are base64'd in place, larger ones become an attachment.
+
+        >>> cdb=CouchableDb('testing', arrayMinLen=3)
+        >>> parent_doc = {}
+        >>> attachment_dict = {}
+        >>> packed = cdb._pack_array(parent_doc, [1, 2, 3], attachment_dict, 'myname', 'i')
+        >>> packed.split(':')[:4]
+        ['couchable', 'array', 'i', 'b64']
+        >>> cdb._unpack(parent_doc, packed, {})
+        [1, 2, 3]
+        """
+        arr = array.array(typecode, data)
+        if sys.byteorder == 'big':
+            arr.byteswap()
+
+        content = doGzip(arr.tostring())
+        name = str(name)
+
+        if len(content) > self._maxStrLen:
+            assert name not in attachment_dict
+
+            attachment_dict[name] = (content, 'application/octet-stream')
+            return '{}{}:{}:{}:{}'.format(FIELD_NAME, 'array', typecode, 'attachment', name)
+        else:
+            return '{}{}:{}:{}:{}'.format(FIELD_NAME, 'array', typecode, 'b64', base64.b64encode(content))
 
     @_packer(dict)
     def _pack_dict_keyMeansObject(self, parent_doc, data, attachment_dict, name, isObjDict, topLevel=False):
@@ -971,32 +2211,14 @@ class CouchableDb(object):
             return self._pack_object(parent_doc, data, attachment_dict, name, False) # FIXME???
 
 
-        if isObjDict:
-            nameFormat_str = '{}.{}'
-        else:
-            nameFormat_str = '{}[{}]'
-
         if topLevel:
             private_keys = {k for k in data.keys() if k.startswith('_') and k not in ('_id', '_rev', '_attachments', '_cdb', '_couchableMultipartPending')}
         else:
             private_keys = set()
 
-        doc = {}
-        for k,v in data.items():
-            if k not in private_keys and k not in set(['_attachments', '_cdb', '_couchableMultipartPending']):
-                if isObjDict:
-                    k_str = str(k)
-                else:
-                    k_str = repr(k)
-
-                k_packed = self._pack(parent_doc, k, attachment_dict, '{}>{}'.format(name, k_str), True)
-                v_packed = self._pack(parent_doc, v, attachment_dict, nameFormat_str.format(name, k_str), False)
-
-                doc[k_packed] = v_packed
-
-        #doc = {self._pack(parent_doc, k, attachment_dict, '{}>{}'.format(name, str(k)), True):
-        #    self._pack(parent_doc, v, attachment_dict, nameFormat_str.format(name, str(k)), False)
-        #    for k,v in data.items() if k not in private_keys and k not in set(['_attachments', '_cdb'])}
+        stack = []
+        doc = self._push_dict(stack, parent_doc, {}, {k: v for k, v in data.items() if k not in private_keys}, attachment_dict, name, isObjDict)
+        self._pack_iter(parent_doc, stack, attachment_dict)
 
         #assert '_attachments' not in doc, ', '.join([str(data), str(isObjDict)])
 
@@ -1006,8 +2228,8 @@ class CouchableDb(object):
             parent_doc.setdefault(FIELD_NAME, {})
             #doc[FIELD_NAME].setdefault('private', {})
             parent_doc[FIELD_NAME]['private'] = {
-                    self._pack(parent_doc, k, attachment_dict, '{}>{}'.format(name, str(k)), True):
-                    self._pack(parent_doc, v, attachment_dict, '{}.{}'.format(name, str(k)), False)
+                    self._pack(parent_doc, k, attachment_dict, _PathName(name, '{}>{!s}', k), True):
+                    self._pack(parent_doc, v, attachment_dict, _PathName(name, '{}.{!s}', k), False)
                     for k,v in data.items() if k in private_keys}
             #parent_doc.setdefault(FIELD_NAME, {})
             #parent_doc[FIELD_NAME]['private'] = {self._pack(parent_doc, k, attachment_dict, '{}>{}'.format(name, str(k)), True):
@@ -1017,23 +2239,27 @@ class CouchableDb(object):
         return doc
 
     def _pack_attachment(self, parent_doc, data, attachment_dict, name, isKey):
-        log_internal.debug("{}: {} @ {}, {}".format(type(data), getattr(data, '_id', None), getattr(data, '_rev', None), name))
+        name = str(name)
+        if _trace_pack.on:
+            _trace_pack("{}: {} @ {}, {}", type(data), getattr(data, '_id', None), getattr(data, '_rev', None), name)
         cls = type(data)
 
         base_cls, handler_tuple = findHandler(cls, _attachment_handlers)
-        log_internal.debug("{}: {}, {}".format(type(data), base_cls, handler_tuple))
+        _trace_pack("{}: {}, {}", type(data), base_cls, handler_tuple)
 
         assert base_cls is not None
         assert name not in attachment_dict
 
         content = handler_tuple[0](data)
-        log_internal.debug("{}: content len {}".format(type(data), len(content)))
+        _trace_pack("{}: content len {}", type(data), len(content))
         attachment_dict[name] = (content, handler_tuple[2])
         return '{}{}:{}:{}'.format(FIELD_NAME, 'attachment', typestr(base_cls), name)
 
     @_packer(type)
     def _pack_pickle(self, parent_doc, data, attachment_dict, name, isKey):
-        log_internal.debug("{}: {} @ {}, {}".format(type(data), getattr(data, '_id', None), getattr(data, '_rev', None), name))
+        name = str(name)
+        if _trace_pack.on:
+            _trace_pack("{}: {} @ {}, {}", type(data), getattr(data, '_id', None), getattr(data, '_rev', None), name)
         attachment_dict.setdefault('pickles', {})
 
         assert name not in attachment_dict['pickles']
@@ -1048,134 +2274,269 @@ class CouchableDb(object):
 
 
     def _unpack(self, parent_doc, doc, loaded_dict, inst=None):
+        """
+        Turns the JSON-decoded C{doc} back into python objects.  Lists, dicts
+        and objects are walked with an explicit stack (see L{_unpack_iter}),
+        so deeply nested data doesn't hit the recursion limit.
+
+        >>> cdb=CouchableDb('testing')
+        >>> cdb._unpack({}, {'a': [1, 'couchable:repr:int:2', {'couchable:': {'module': '__builtin__', 'class': 'tuple', 'args': [[3]], 'kwargs': {}}}]}, {})
+        {'a': [1, 2, (3,)]}
+        """
+        unpacked = [None]
+        self._unpack_iter(parent_doc, [(unpacked, 0, doc)], loaded_dict, inst)
+
+        return unpacked[0]
+
+    def _unpack_iter(self, parent_doc, stack, loaded_dict, inst=None):
+        """
+        Pops C{(unpacked, slot, doc)} items off of C{stack} and stores the
+        unpacked form of C{doc} in C{unpacked[slot]} until the stack is empty.
+
+        Lists, dicts and objects get their (empty) result put into their slot
+        right away, and their children get pushed onto the stack.  Objects
+        built from constructor args can't be made until their args are done,
+        so those push a C{(None, func, args)} item underneath their children
+        that calls C{func(*args)} once the children have all been popped.
+
+        C{inst} is used in place of creating a new instance for the first
+        object encountered (see L{_load}).
+
+        Shared objects (see the C{shareRefs} option) can have their
+        back-references show up before the object itself does; in that case
+        the object gets unpacked at the back-reference instead, and the
+        original spot just picks up the same instance later.
+        """
+        item = None
+        ref_dict = {}
+        refDoc_dict = None
+
         try:
-            if isinstance(doc, (str, unicode)):
-                if doc.startswith(FIELD_NAME):
-                    _, method_str, data = doc.split(':', 2)
-
-                    if method_str == 'id':
-                        return self._load(data, loaded_dict)
-
-                    elif method_str == 'module':
-                        return importstr(data)
-
-                    elif method_str == 'pickle':
-                        if 'pickles' not in parent_doc[FIELD_NAME]:
-                            attachment_response = self.db.get_attachment(parent_doc, 'pickles')
-                            parent_doc[FIELD_NAME]['pickles'] = pickle.loads(doGunzip(attachment_response.read()))
-                            #parent_doc[FIELD_NAME]['pickles'] = collections.defaultdict(int)
-
-                        return parent_doc[FIELD_NAME]['pickles'][data]
-
-                    type_str, data = data.split(':', 1)
-                    if method_str == 'append':
-                        if type_str == 'unicode':
-                            if isinstance(data, unicode):
-                                return data
-                            else:
-                                return unicode(data, 'utf8')
-                        if type_str == 'str':
-                            return str(data)
-
-                    elif method_str == 'repr':
-                        if type_str in __builtins__:
-                            return __builtins__.get(type_str)(data)
-                        elif type_str == '__builtin__.NoneType':
-                            return None
-                        else:
-                            return importstr(*type_str.rsplit('.', 1))(data)
+            while stack:
+                item = unpacked, slot, doc = stack.pop()
 
-                    elif method_str == 'key':
-                        return self._unpack(parent_doc, parent_doc[FIELD_NAME]['keys'][doc], loaded_dict)
+                if unpacked is None:
+                    slot(*doc)
+                    continue
 
+                cls = type(doc)
 
-                    elif method_str == 'attachment':
-                        base_cls, handler_tuple = findHandler(type_str, _attachment_handlers)
-                        attachment_response = self.db.get_attachment(parent_doc, data)
-                        return handler_tuple[1](attachment_response.read())
+                if cls is unicode or cls is str:
+                    if doc.startswith(_ref_prefix):
+                        ref = int(doc[len(_ref_prefix):])
+                        if ref in ref_dict:
+                            unpacked[slot] = ref_dict[ref]
+                        else:
+                            if refDoc_dict is None:
+                                refDoc_dict = self._unpack_refDoc_dict(parent_doc)
+                            stack.append((unpacked, slot, refDoc_dict[ref]))
 
-                    elif method_str == 'custom':
-                        base_cls, unpack_func = findHandler(type_str, _unpack_handlers)
+                    elif doc.startswith(FIELD_NAME):
+                        unpacked[slot] = self._unpack_str(parent_doc, doc, loaded_dict)
+                    else:
+                        unpacked[slot] = doc
 
-                        assert unpack_func is not None, "Custom unpacker not found for {} (make sure that the modules where the custom packers are defined get imported first)".format(type_str)
-                        #attachment_response = self.db.get_attachment(parent_doc, data)
-                        #return handler_tuple[1](attachment_response.read())
+                elif cls is list or isinstance(doc, list):
+                    unpacked_list = unpacked[slot] = [None] * len(doc)
+                    for i in xrange(len(doc) - 1, -1, -1):
+                        stack.append((unpacked_list, i, doc[i]))
 
-                        #unpack_func = handler_tuple[1]
-                        return unpack_func(data)
+                elif cls is dict or isinstance(doc, dict):
+                    if FIELD_NAME in doc:
+                        self._unpack_object(parent_doc, stack, unpacked, slot, doc, loaded_dict, inst, ref_dict)
+                        inst = None
                     else:
-                        # FIXME: error?
-                        pass
+                        unpacked_dict = unpacked[slot] = {}
+                        for k, v in doc.iteritems():
+                            stack.append((unpacked_dict, self._unpack_key(parent_doc, k, loaded_dict), v))
 
                 else:
-                    return doc
+                    unpacked[slot] = doc
+        except:
+            log_internal.exception("Error with: {}".format(item[2] if item else None))
+            raise
 
-            elif isinstance(doc, (int, float)):
-                return doc
+    def _unpack_key(self, parent_doc, doc, loaded_dict):
+        if doc.startswith(FIELD_NAME):
+            return self._unpack_str(parent_doc, doc, loaded_dict)
 
-            elif isinstance(doc, list):
-                return [self._unpack(parent_doc, x, loaded_dict) for x in doc]
+        return doc
 
+    def _unpack_refDoc_dict(self, parent_doc):
+        """
+        Maps the ref ids of the shared objects in C{parent_doc} to their
+        packed form.  Only needed when a back-reference is unpacked before
+        the object it points to.
+        """
+        refDoc_dict = {}
+        stack = [parent_doc]
+
+        while stack:
+            doc = stack.pop()
+
+            if isinstance(doc, list):
+                stack.extend(doc)
             elif isinstance(doc, dict):
-                if FIELD_NAME in doc:
-                    info = doc[FIELD_NAME]
-                    #if 'pickles' in info:
-                    #    info['pickles'] = pickle.loads(info['pickles'])
-
-                    cls = importstr(info['module'], info['class'])
-
-                    if 'args' in info and 'kwargs' in info:
-                        #print cls, doc['args'], doc['kwargs']
-                        args = None
-                        kwargs = None
-                        try:
-                            args = self._unpack(parent_doc, info['args'], loaded_dict)
-                            kwargs = self._unpack(parent_doc, info['kwargs'], loaded_dict)
-
-                            inst = cls(*args, **kwargs)
-                        except:
-                            log_internal.error("Error unpacking args, kwargs for: {} {} {}".format(cls, args, kwargs))
-                            raise
+                info = doc.get(FIELD_NAME)
+                if isinstance(info, dict) and 'ref' in info and 'module' in info:
+                    refDoc_dict[info['ref']] = doc
 
-                    else:
-                        if inst is None:
-                            inst = cls.__new__(cls)
-                            # This is important, see test_docCycles
-                            #print doc
-                            if '_id' in doc:
-                                self._obj_by_id[doc['_id']] = inst
+                stack.extend(doc.values())
 
-                        #print "unpack isinstance(doc, dict) doc:", doc.get('_id', 'still no id')
-                        #print "unpack isinstance(doc, dict) doc:", doc.get('_rev', 'still no rev')
+        return refDoc_dict
 
-                        #inst.__dict__.update(info.get('private', {}))
-                        inst.__dict__.update({self._unpack(parent_doc, k, loaded_dict): self._unpack(parent_doc, v, loaded_dict) for k,v in info.get('private', {}).items()})
+    def _unpack_object(self, parent_doc, stack, unpacked, slot, doc, loaded_dict, inst=None, ref_dict=None):
+        info = doc[FIELD_NAME]
+        #if 'pickles' in info:
+        #    info['pickles'] = pickle.loads(info['pickles'])
 
-                        if '_id' in doc:
-                            inst.__dict__['_id'] = doc['_id']
-                            inst.__dict__['_rev'] = doc['_rev']
+        cls_key = (info['module'], info['class'])
+        cls = _cls_cache.get(cls_key)
+        if cls is None:
+            cls = _cls_cache[cls_key] = importstr(*cls_key)
 
-                        # If we haven't stuffed the cache AND pre-set the id/rev, then this goes into an infinite loop.  See test_docCycles
-                        inst.__dict__.update({self._unpack(parent_doc, k, loaded_dict): self._unpack(parent_doc, v, loaded_dict) for k,v in doc.items() if k != FIELD_NAME})
+        if 'columnar' in info:
+            inst_list = unpacked[slot] = [cls.__new__(cls) for i in range(info['columnar'])]
 
-                        if 'list' in info:
-                            list.extend(inst, self._unpack(parent_doc, info['list'], loaded_dict))
-                        if 'dict' in info:
-                            dict.update(inst, self._unpack(parent_doc, info['dict'], loaded_dict))
+            for k, column in doc.items():
+                if k != FIELD_NAME:
+                    k = self._unpack_key(parent_doc, k, loaded_dict)
+                    for inst, v in itertools.izip(inst_list, column):
+                        stack.append((inst.__dict__, k, v))
 
-                        #print "unpack isinstance(doc, dict) inst:", inst.__dict__.get('_id', 'still no id')
-                        #print "unpack isinstance(doc, dict) inst:", inst.__dict__.get('_rev', 'still no rev')
+        elif 'args' in info and 'kwargs' in info:
+            args_list = [None, None]
 
-                    #print "Unpacking:", inst
-                    return inst
+            stack.append((None, self._unpack_consargs, (unpacked, slot, cls, args_list)))
+            stack.append((args_list, 1, info['kwargs']))
+            stack.append((args_list, 0, info['args']))
 
+        else:
+            ref = info.get('ref')
+            if ref is not None and ref in ref_dict:
+                unpacked[slot] = ref_dict[ref]
+                return
+
+            if inst is None:
+                # This is important, see test_docCycles
+                if '_id' in doc:
+                    # Another thread may be loading the same doc; both need to end up with the same instance.
+                    with self._obj_by_id_lock:
+                        inst = self._obj_by_id.get(doc['_id'])
+                        if inst is None:
+                            inst = self._obj_by_id[doc['_id']] = cls.__new__(cls)
                 else:
-                    return {self._unpack(parent_doc, k, loaded_dict): self._unpack(parent_doc, v, loaded_dict) for k,v in doc.items()}
+                    inst = cls.__new__(cls)
+
+            if ref is not None:
+                ref_dict[ref] = inst
+
+            unpacked[slot] = inst
+
+            if 'list' in info:
+                extra_list = [None]
+                stack.append((None, lambda inst, extra_list: list.extend(inst, extra_list[0]), (inst, extra_list)))
+                stack.append((extra_list, 0, info['list']))
+            if 'dict' in info:
+                extra_list = [None]
+                stack.append((None, lambda inst, extra_list: dict.update(inst, extra_list[0]), (inst, extra_list)))
+                stack.append((extra_list, 0, info['dict']))
+
+            # Pushed first so that they're popped last, and so regular attributes win (same as the old dict.update order).
+            for k, v in doc.items():
+                if k != FIELD_NAME:
+                    stack.append((inst.__dict__, self._unpack_key(parent_doc, k, loaded_dict), v))
+
+            for k, v in info.get('private', {}).items():
+                stack.append((inst.__dict__, self._unpack_key(parent_doc, k, loaded_dict), v))
+
+            # If we haven't stuffed the cache AND pre-set the id/rev, then this goes into an infinite loop.  See test_docCycles
+            if '_id' in doc:
+                inst.__dict__['_id'] = doc['_id']
+                inst.__dict__['_rev'] = doc['_rev']
+
+    def _unpack_consargs(self, unpacked, slot, cls, args_list):
+        args, kwargs = args_list
+        try:
+            unpacked[slot] = cls(*args, **kwargs)
         except:
-            log_internal.exception("Error with: {}".format(doc))
+            log_internal.error("Error unpacking args, kwargs for: {} {} {}".format(cls, args, kwargs))
             raise
 
-    def load(self, what, loaded=None):
+    def _unpack_str(self, parent_doc, doc, loaded_dict):
+        _, method_str, data = doc.split(':', 2)
+
+        if method_str == 'id':
+            if isinstance(loaded_dict, _RecordLoadedDict):
+                return self._loadRecord(data, loaded_dict)
+            return self._load(data, loaded_dict)
+
+        elif method_str == 'module':
+            return importstr(data)
+
+        elif method_str == 'pickle':
+            if 'pickles' not in parent_doc[FIELD_NAME]:
+                attachment_response = self.db.get_attachment(parent_doc, 'pickles')
+                parent_doc[FIELD_NAME]['pickles'] = pickle.loads(doGunzip(attachment_response.read()))
+                #parent_doc[FIELD_NAME]['pickles'] = collections.defaultdict(int)
+
+            return parent_doc[FIELD_NAME]['pickles'][data]
+
+        type_str, data = data.split(':', 1)
+        if method_str == 'append':
+            if type_str == 'unicode':
+                if isinstance(data, unicode):
+                    return data
+                else:
+                    return unicode(data, 'utf8')
+            if type_str == 'str':
+                return str(data)
+
+        elif method_str == 'repr':
+            if type_str in __builtins__:
+                return __builtins__.get(type_str)(data)
+            elif type_str == '__builtin__.NoneType':
+                return None
+            else:
+                return importstr(*type_str.rsplit('.', 1))(data)
+
+        elif method_str == 'key':
+            return self._unpack(parent_doc, parent_doc[FIELD_NAME]['keys'][doc], loaded_dict)
+
+
+        elif method_str == 'array':
+            storage_str, data = data.split(':', 1)
+            if storage_str == 'attachment':
+                content = self.db.get_attachment(parent_doc, data).read()
+            else:
+                content = base64.b64decode(data)
+
+            arr = array.array(type_str, doGunzip(content))
+            if sys.byteorder == 'big':
+                arr.byteswap()
+
+            return arr.tolist()
+
+        elif method_str == 'attachment':
+            base_cls, handler_tuple = findHandler(type_str, _attachment_handlers)
+            attachment_response = self.db.get_attachment(parent_doc, data)
+            return handler_tuple[1](attachment_response.read())
+
+        elif method_str == 'custom':
+            base_cls, unpack_func = findHandler(type_str, _unpack_handlers)
+
+            assert unpack_func is not None, "Custom unpacker not found for {} (make sure that the modules where the custom packers are defined get imported first)".format(type_str)
+            #attachment_response = self.db.get_attachment(parent_doc, data)
+            #return handler_tuple[1](attachment_response.read())
+
+            #unpack_func = handler_tuple[1]
+            return unpack_func(data)
+        else:
+            # FIXME: error?
+            pass
+
+
+    def load(self, what, loaded=None, fields=None, readOnly=False):
         """
         Loads the indicated object(s) out of CouchDB.
 
@@ -1200,6 +2561,10 @@ class CouchableDb(object):
         @param what: A document C{_id}, a dict with an C{'_id'} key, a couchdb.client.Row instance, or a list of any of the preceding.
         @type  loaded: dict, couchdb.client.Row or list of same
         @param loaded: A mapping of document C{_id}s to documents that have already been loaded out of the database.
+        @type  fields: list of str
+        @param fields: Only unpack these attributes (see L{_loadPartial}); the objects returned are new, partial objects that can't be stored.
+        @type  readOnly: bool
+        @param readOnly: Return read-only records instead of objects (see L{_loadRecord}).
         @rtype: obj or list
         @return: The object indicated by the C{what} parameter, or a list of such objects if C{what} was a list.
         """
@@ -1220,10 +2585,11 @@ class CouchableDb(object):
         else:
             load_list = what
 
+        _refreshTracing()
         if len(load_list) > 3:
-            log_api.info('CouchableDb.load(what={!r}, loaded={!r})'.format(load_list[:3] + ['...'], loaded))
+            _trace_api('CouchableDb.load(what={!r}, loaded={!r})', load_list[:3] + ['...'], loaded)
         else:
-            log_api.info('CouchableDb.load(what={!r}, loaded={!r})'.format(what, loaded))
+            _trace_api('CouchableDb.load(what={!r}, loaded={!r})', what, loaded)
 
 
         for item in load_list:
@@ -1231,6 +2597,13 @@ class CouchableDb(object):
             if isinstance(item, basestring):
                 id_list.append(item)
             elif isinstance(item, couchdb.client.Row):
+                # Linked rows (see defineClassView) carry a referenced doc;
+                # other views can emit docs (with an _id) as values too.
+                if isinstance(item.get('value'), dict) and item['value'].get(FIELD_NAME + 'linked'):
+                    if item.doc is not None:
+                        loaded_dict[item.doc['_id']] = item.doc
+                    continue
+
                 id_list.append(item.id)
 
                 if hasattr(item, 'doc'):
@@ -1256,21 +2629,121 @@ class CouchableDb(object):
         #print "todo_list:", len(todo_list), todo_list
 
 
-        for row in self.db.view('_all_docs', include_docs=True, keys=todo_list).rows:
-            assert row.id == row.doc['_id'], "{!r} != {!r}".format(row.id, row.doc['_id'])
-            loaded_dict[row.id] = row.doc
+        # Rows from include_docs views usually have everything already.
+        if todo_list:
+            for row in self.db.view('_all_docs', include_docs=True, keys=todo_list).rows:
+                assert row.id == row.doc['_id'], "{!r} != {!r}".format(row.id, row.doc['_id'])
+                loaded_dict[row.id] = row.doc
+
+        if readOnly:
+            loaded_dict = _RecordLoadedDict(loaded_dict)
+            obj_list = [self._loadRecord(_id, loaded_dict, fields) for _id in id_list]
+        elif fields is not None:
+            obj_list = [self._loadPartial(_id, loaded_dict, fields) for _id in id_list]
+        else:
+            obj_list = [self._load(_id, loaded_dict, True) for _id in id_list]
 
         if not isinstance(what, list):
             #print "what", what
-            return [self._load(_id, loaded_dict, True) for _id in id_list][0]
+            return obj_list[0]
         else:
             #print "id_list", id_list
-            return [self._load(_id, loaded_dict, True) for _id in id_list]
+            return obj_list
+
+    def _loadRecord(self, _id, loaded_dict, fields=None):
+        """
+        Unpacks a doc into a read-only record: a tuple subclass (made per
+        class and set of attribute names, see L{_recordClass}) with C{_id},
+        C{_rev} and the doc's attributes (underscore ones included) as
+        properties, and C{_cls} for the class the doc was stored as.
+        Records aren't kept in C{_obj_by_id}, don't get C{_cdb} set, and
+        don't have post-load callbacks run, so they cost little to make and
+        go away as soon as they're no longer used.
+
+        Referenced docs come back as records too (one per id per L{load}
+        call); a reference back to a record that's still being made comes
+        back as the C{_id} string, since tuples can't be part of a cycle.
+        Nested objects that aren't docs, pickles and attachments are
+        unpacked as usual.  Docs that aren't plain objects (say, dict
+        subclasses) are unpacked as usual, minus the id bookkeeping.
+        """
+        record = loaded_dict.record_dict.get(_id)
+        if record is not None:
+            return record
+        if _id in loaded_dict.active_set:
+            return _id
+
+        if _id not in loaded_dict:
+            loaded_dict[_id] = self.db[_id]
+        doc = loaded_dict[_id]
+
+        info = doc.get(FIELD_NAME, {})
+        loaded_dict.active_set.add(_id)
+        try:
+            if set(info) & set(['args', 'kwargs', 'list', 'dict', 'columnar']):
+                part_doc = {k: v for k, v in doc.items() if k not in ('_id', '_rev', '_attachments')}
+                record = self._unpack(doc, part_doc, loaded_dict)
+            else:
+                part_doc = {k: v for k, v in doc.items() if k != FIELD_NAME and k not in ('_id', '_rev', '_attachments')}
+                part_doc.update(info.get('private', {}))
+                if fields is not None:
+                    part_doc = {k: v for k, v in part_doc.items() if k in fields}
+
+                value_dict = self._unpack(doc, part_doc, loaded_dict)
+
+                cls_key = (info.get('module'), info.get('class'))
+                cls = _cls_cache.get(cls_key)
+                if cls is None:
+                    cls = _cls_cache[cls_key] = importstr(*cls_key) if info else dict
+
+                name_list = sorted(value_dict)
+                record = _recordClass(cls, tuple(['_id', '_rev'] + name_list))([doc['_id'], doc['_rev']] + [value_dict[name] for name in name_list])
+        finally:
+            loaded_dict.active_set.discard(_id)
+
+        loaded_dict.record_dict[_id] = record
+
+        return record
+
+    def _loadPartial(self, _id, loaded_dict, fields):
+        """
+        Unpacks just the attributes named in C{fields} (underscore ones
+        included) into a new instance, so that only what's needed for them
+        (referenced docs, pickles, attachments) gets loaded.  The instance
+        isn't the one that L{load} would give back for the same id, and
+        it's marked with C{_couchablePartial}, so that L{store} refuses it.
+        Post-load callbacks aren't run for partial objects.
+
+        The whole document still comes from CouchDB; what's saved is the
+        unpacking (and any fetches) for the other attributes.
+        """
+        if _id not in loaded_dict:
+            loaded_dict[_id] = self.db[_id]
+        doc = loaded_dict[_id]
+
+        info = doc.get(FIELD_NAME, {})
+        part_info = {k: v for k, v in info.items() if k not in ('private', 'list', 'dict', 'ref')}
+        part_info['private'] = {k: v for k, v in info.get('private', {}).items() if k in fields}
+
+        part_doc = {k: v for k, v in doc.items() if k in fields and not k.startswith('_')}
+        part_doc[FIELD_NAME] = part_info
+
+        # Unpacked without an _id, so that the instance doesn't go into (or
+        # come out of) _obj_by_id.  The whole doc is the parent, for
+        # attachments, pickles, and shared objects whose first occurrence is
+        # in an attribute that isn't being loaded.
+        obj = self._unpack(doc, part_doc, loaded_dict)
+
+        obj.__dict__['_id'] = doc['_id']
+        obj.__dict__['_rev'] = doc['_rev']
+        obj.__dict__['_couchablePartial'] = tuple(fields)
+
+        return obj
 
 
     def _load(self, _id, loaded_dict, force=False):
         if _id not in loaded_dict:
-            log_internal.debug("Fetching object from DB: {}".format(_id))
+            _trace_load("Fetching object from DB: {}", _id)
             try:
                 doc = self.db[_id]
                 assert _id == doc['_id']
@@ -1285,9 +2758,12 @@ class CouchableDb(object):
 
         obj = self._obj_by_id.get(_id, None)
         if obj is None or getattr(obj, '_rev', None) != doc['_rev'] or force:
-            log_internal.debug("Unpacking object: {}".format(_id))
+            _trace_load("Unpacking object: {}", _id)
             obj = self._unpack(doc, doc, loaded_dict, obj)
 
+            if self._patchUpdates:
+                self._rememberDoc(doc, doc['_rev'])
+
         base_cls, func_tuple = findHandler(type(obj), _couchable_types)
         if func_tuple:
             func_tuple[1](obj, self)
@@ -1300,10 +2776,819 @@ class CouchableDb(object):
 
         return obj
 
+    def loadView(self, viewName, fields=None, readOnly=False, **kwargs):
+        """
+        Loads the objects for the rows of a view, in row order.  Shorthand
+        for::
+
+            cdb.load(cdb.db.view(viewName, include_docs=True, **kwargs).rows)
+
+        @type  viewName: str
+        @param viewName: The name of the view, like C{'couchable/' + fullName} (see L{addClassView}).
+        @type  fields: list of str
+        @param fields: Passed along to L{load}.
+        @type  readOnly: bool
+        @param readOnly: Passed along to L{load}.
+        @param kwargs: Passed along to C{couchdb.Database.view}.
+        @rtype: list
+        @return: The objects for the view rows.
+        """
+        return self.load(self.db.view(viewName, include_docs=True, **kwargs).rows, fields=fields, readOnly=readOnly)
+
+    def iterView(self, viewName, pageSize=1000, prefetch=True, fields=None, readOnly=False, **kwargs):
+        """
+        Like L{loadView}, but yields the objects one at a time, fetching the
+        view C{pageSize} rows at a time (paging with C{startkey} and
+        C{startkey_docid}).  Only about two pages of rows and objects are
+        held at once, so this can be used to scan views of any size.
+
+        With C{prefetch}, the next page gets fetched on a background thread
+        while the current page is being unpacked and iterated over.
+
+        @type  viewName: str
+        @param viewName: The name of the view, like C{'couchable/' + fullName} (see L{addClassView}).
+        @type  pageSize: int
+        @param pageSize: How many rows to fetch per request.
+        @type  prefetch: bool
+        @param prefetch: Fetch the next page while the current one is in use.
+        @type  fields: list of str
+        @param fields: Passed along to L{load}.
+        @type  readOnly: bool
+        @param readOnly: Passed along to L{load}.
+        @param kwargs: Passed along to C{couchdb.Database.view}; C{limit} caps the total number of rows, C{skip} only applies to the first page, and C{keys} isn't supported.
+        @rtype: generator
+        @return: The objects for the view rows, in row order.
+        """
+        for row_list in self._iterViewPages(viewName, pageSize, prefetch, kwargs):
+            for obj in self.load(row_list, fields=fields, readOnly=readOnly):
+                yield obj
+
+    def _iterViewPages(self, viewName, pageSize, prefetch, kwargs, includeDocs=True):
+        """
+        Does the paging for L{iterView}; yields lists of view rows.
+        """
+        if 'keys' in kwargs:
+            raise TypeError("Paging views doesn't support keys")
+
+        kwargs = dict(kwargs)
+        limit = kwargs.pop('limit', None)
+
+        def fetch(kwargs, count):
+            # One extra row, to be the start of the next page.
+            return list(self.db.view(viewName, include_docs=includeDocs, limit=count + 1, **kwargs))
+
+        def nextPage(kwargs, remaining):
+            count = pageSize if remaining is None else min(pageSize, remaining)
+            if prefetch:
+                return count, _getThreadPool().apply_async(fetch, (kwargs, count))
+            else:
+                return count, fetch(kwargs, count)
+
+        remaining = limit
+        count, page = nextPage(kwargs, remaining)
+        while True:
+            row_list = page.get() if prefetch else page
+
+            if remaining is not None:
+                remaining -= min(count, len(row_list))
+
+            if len(row_list) > count and remaining != 0:
+                next_row = row_list.pop()
+                kwargs = dict(kwargs, startkey=next_row.key, startkey_docid=next_row.id)
+                kwargs.pop('skip', None)
+                count, page = nextPage(kwargs, remaining)
+            else:
+                del row_list[count:]
+                kwargs = None
+
+            yield row_list
+
+            if kwargs is None:
+                break
+
+    def iterViewParallel(self, viewName, ranges=4, pageSize=1000, ordered=False, **kwargs):
+        """
+        Like L{iterView}, but splits the view's key range into C{ranges}
+        pieces, and scans each piece on its own thread (and so its own
+        connection), loading the objects there as well.
+
+        The split points are found by asking CouchDB for the row offsets of
+        the start and end of the range, then sampling rows evenly spaced
+        between them (with C{skip}), so splitting costs C{ranges + 1} small
+        requests.  Views with a reduce function need C{reduce=False}.
+
+        @type  viewName: str
+        @param viewName: The name of the view, like C{'couchable/' + fullName} (see L{addClassView}).
+        @type  ranges: int
+        @param ranges: How many pieces to split the scan into.  Fewer are used if the view is small compared to C{pageSize}.
+        @type  pageSize: int
+        @param pageSize: How many rows to fetch per request.
+        @type  ordered: bool
+        @param ordered: Yield the objects in row order.  Otherwise, each page of objects is yielded as soon as it's loaded.
+        @param kwargs: Passed along to C{couchdb.Database.view}; C{limit}, C{skip} and C{keys} aren't supported.
+        @rtype: generator
+        @return: The objects for the view rows.
+        """
+        for name in ('limit', 'skip', 'keys'):
+            if name in kwargs:
+                raise TypeError("iterViewParallel doesn't support {}".format(name))
+
+        split_list = self._viewSplits(viewName, ranges, pageSize, kwargs)
+
+        range_list = []
+        bound_list = [None] + split_list + [None]
+        for start_tup, end_tup in itertools.izip(bound_list, bound_list[1:]):
+            range_kwargs = dict(kwargs)
+            if start_tup is not None:
+                range_kwargs.update(startkey=start_tup[0], startkey_docid=start_tup[1])
+            if end_tup is not None:
+                range_kwargs.update(endkey=end_tup[0], endkey_docid=end_tup[1], inclusive_end=False)
+            range_list.append(range_kwargs)
+
+        if _trace_api.on:
+            _trace_api('CouchableDb.iterViewParallel({!r}) split into: {!r}', viewName, range_list)
+
+        # Ordered scans need a queue per range, so that the later ranges can
+        # keep going (a couple of pages ahead) while the first is consumed.
+        if ordered:
+            queue_list = [Queue.Queue(2) for range_kwargs in range_list]
+        else:
+            queue_list = [Queue.Queue(2 * len(range_list))] * len(range_list)
+
+        stop_event = threading.Event()
+
+        def put(queue, item):
+            while not stop_event.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def scan(queue, range_kwargs):
+            try:
+                for row_list in self._iterViewPages(viewName, pageSize, False, range_kwargs):
+                    put(queue, (self.load(row_list), None))
+                    if stop_event.is_set():
+                        return
+                put(queue, (None, None))
+            except Exception, e:
+                log_internal.exception("Error scanning {} with {!r}".format(viewName, range_kwargs))
+                put(queue, (None, e))
+
+        thread_list = []
+        for queue, range_kwargs in itertools.izip(queue_list, range_list):
+            thread = threading.Thread(target=scan, args=(queue, range_kwargs), name='couchable-scan')
+            thread.daemon = True
+            thread.start()
+            thread_list.append(thread)
+
+        try:
+            if ordered:
+                todo_list = [(queue, 1) for queue in queue_list]
+            else:
+                todo_list = [(queue_list[0], len(queue_list))]
+
+            for queue, running in todo_list:
+                while running:
+                    obj_list, e = queue.get()
+                    if e is not None:
+                        raise e
+                    elif obj_list is None:
+                        running -= 1
+                    else:
+                        for obj in obj_list:
+                            yield obj
+        finally:
+            stop_event.set()
+
+    def _viewSplits(self, viewName, ranges, pageSize, kwargs):
+        """
+        Picks the C{(key, docid)} split points for L{iterViewParallel}.
+        """
+        start_kwargs = dict(kwargs)
+        for name in ('endkey', 'endkey_docid', 'inclusive_end'):
+            start_kwargs.pop(name, None)
+
+        start_offset = self.db.view(viewName, limit=0, **start_kwargs).offset
+
+        if 'endkey' in kwargs:
+            end_kwargs = dict(start_kwargs, startkey=kwargs['endkey'])
+            end_kwargs.pop('startkey_docid', None)
+            if 'endkey_docid' in kwargs:
+                end_kwargs['startkey_docid'] = kwargs['endkey_docid']
+
+            end_offset = self.db.view(viewName, limit=0, **end_kwargs).offset
+        else:
+            end_offset = self.db.view(viewName, limit=0, **start_kwargs).total_rows
+
+        count = max(0, end_offset - start_offset)
+        ranges = max(1, min(ranges, count // pageSize))
+
+        split_list = []
+        for i in range(1, ranges):
+            row_list = list(self.db.view(viewName, skip=count * i // ranges, limit=1, **kwargs))
+            if row_list and (not split_list or split_list[-1] != (row_list[0].key, row_list[0].id)):
+                split_list.append((row_list[0].key, row_list[0].id))
+
+        return split_list
+
+    def iterClass(self, cls, name, pageSize=1000, prefetch=True, fields=None, readOnly=False, **kwargs):
+        """
+        Shorthand for L{iterView} on a view made by L{addClassView}::
+
+            for obj in cdb.iterClass(Foo, 'bar', startkey=[3], endkey=[7, {}]):
+                ...
+
+        @type  cls: type
+        @param cls: The class given to L{addClassView}.
+        @type  name: str
+        @param name: The name given to L{addClassView} (or L{defineClassView}).
+        @rtype: generator
+        @return: The objects for the view rows, in row order.
+        """
+        fullName = 'byclass-{}-{}--{}'.format(cls.__module__, cls.__name__, name)
+
+        return self.iterView(_classViewDesign_dict.get(fullName, 'couchable') + '/' + fullName, pageSize, prefetch, fields, readOnly, **kwargs)
+
+    def query(self, cls, pageSize=1000, **kwargs):
+        """
+        Loads the instances of C{cls} whose attributes match C{kwargs},
+        using one of the indexes given to L{registerDocType}.  The index
+        used is the one made of exactly the attributes given.  Each
+        attribute can be matched against:
+
+            - a single value;
+            - a list (or set, tuple, or C{range(...)}) of values, any of which match;
+            - a C{slice(start, stop)}, for C{start <= value < stop} (either end can be None).
+
+        Only the last attribute of the index can be a slice::
+
+            cdb.query(Foo, name=['a', 'b'], x=slice(3, 8))
+
+        The indexes get synced the first time they're needed.  Lists of
+        values turn into C{keys} view requests (C{pageSize} keys at a time),
+        and slices into paged range requests; either way, objects are loaded
+        a page at a time.
+
+        @type  cls: type
+        @param cls: The registered document type to query.
+        @type  pageSize: int
+        @param pageSize: How many keys or rows to ask for per request.
+        @rtype: list
+        @return: The matching objects, in index order (and then key order, for lists).
+        """
+        slice_list = [name for name, value in kwargs.items() if isinstance(value, slice)]
+
+        for attr_tup, viewName in _index_dict.get(cls, {}).items():
+            if set(attr_tup) == set(kwargs) and slice_list in ([], [attr_tup[-1]]):
+                break
+        else:
+            raise ValueError("No index on {} for {!r}; indexes: {!r}".format(typestr(cls), sorted(kwargs), _index_dict.get(cls, {}).keys()))
+
+        self.syncViews([viewName.split('/')[0]])
+
+        prefix_list = [[]]
+        for name in attr_tup:
+            value = kwargs[name]
+            if isinstance(value, slice):
+                continue
+            elif not isinstance(value, (list, tuple, set, frozenset, xrange)):
+                value = [value]
+
+            prefix_list = [prefix + [x] for prefix in prefix_list for x in value]
+
+        if _trace_api.on:
+            _trace_api('CouchableDb.query({}) using {}: {} prefixes, slice: {!r}', typestr(cls), viewName, len(prefix_list), slice_list)
+
+        obj_list = []
+        if slice_list:
+            value = kwargs[slice_list[0]]
+            for prefix in prefix_list:
+                view_kwargs = {'startkey': prefix + ([] if value.start is None else [value.start])}
+                if value.stop is None:
+                    view_kwargs['endkey'] = prefix + [{}]
+                else:
+                    view_kwargs.update(endkey=prefix + [value.stop], inclusive_end=False)
+
+                for row_list in self._iterViewPages(viewName, pageSize, False, view_kwargs):
+                    obj_list.extend(self.load(row_list))
+        else:
+            for i in range(0, len(prefix_list), pageSize):
+                obj_list.extend(self.load(self.db.view(viewName, include_docs=True, keys=prefix_list[i:i + pageSize]).rows))
+
+        return obj_list
+
+    def aggregate(self, cls, attr=None, reduce='_count', by=None, group_level=None, subclasses=False, **kwargs):
+        """
+        Computes C{reduce} over C{attr} for the instances of C{cls} in
+        CouchDB, without loading them.  The view it needs is defined (in the
+        C{'couchable-aggregate'} design doc) and synced the first time::
+
+            cdb.aggregate(Foo, reduce='_count')                     # 1234
+            cdb.aggregate(Foo, 'x', '_stats')                       # {'sum': ..., 'count': ..., 'min': ..., 'max': ..., 'sumsqr': ...}
+            cdb.aggregate(Foo, 'x', '_sum', by=['kind'])            # {('a',): 17.5, ('b',): 3.0}
+            cdb.aggregate(Foo, reduce='_count', by=['x'])           # A histogram of the values of x.
+
+        For C{_sum} and C{_stats}, instances where C{attr} isn't a number
+        are left out.
+
+        @type  cls: type
+        @param cls: The class to aggregate over.
+        @type  attr: str
+        @param attr: The attribute to aggregate (underscore attributes are fine).  Not needed for C{_count}.
+        @type  reduce: str
+        @param reduce: One of CouchDB's built-in reduce functions (C{'_count'}, C{'_sum'} or C{'_stats'}), or javascript.
+        @type  by: list of str
+        @param by: Attributes to group by.
+        @type  group_level: int
+        @param group_level: How many of the C{by} attributes to group by.  Defaults to all of them.
+        @type  subclasses: bool
+        @param subclasses: Include subclasses (see L{defineClassView}).
+        @param kwargs: Passed along to C{couchdb.Database.view}, for things like C{startkey} and C{endkey}.
+        @rtype: obj or collections.OrderedDict
+        @return: Without C{by}, the reduced value (None if there were no instances).  Otherwise, the reduced values keyed by tuples of the C{by} attribute values, in key order.
+        """
+        by = list(by or [])
+
+        condition = None
+        if attr is None:
+            value_js = '1'
+        else:
+            value_js = 'info.private.' + attr if attr[0] == '_' else 'doc.' + attr
+            if reduce in ('_sum', '_stats'):
+                condition = "typeof {} == 'number'".format(value_js)
+
+        reduce_str = reduce if reduce.startswith('_') else hashlib.sha1(reduce).hexdigest()[:8]
+        name = 'aggregate-{}-{}-by-{}{}'.format(attr, reduce_str, '-'.join(by), '-sub' if subclasses else '')
+        fullName = defineClassView(cls, name, by, value=value_js, reduce=reduce, designDoc='couchable-aggregate', subclasses=subclasses, condition=condition)
+
+        self.syncViews(['couchable-aggregate'])
+
+        if by:
+            kwargs['group_level'] = len(by) if group_level is None else group_level
+
+        if _trace_api.on:
+            _trace_api('CouchableDb.aggregate({}, {!r}, {!r}) using {} with {!r}', typestr(cls), attr, reduce, fullName, kwargs)
+
+        row_list = self.db.view('couchable-aggregate/' + fullName, **kwargs).rows
+
+        if not by:
+            return row_list[0].value if row_list else None
+
+        return collections.OrderedDict((tuple(row.key), row.value) for row in row_list)
+
+    def columns(self, cls, attrs, typecodes='d', pageSize=10000, subclasses=False, **kwargs):
+        """
+        Gathers the values of the C{attrs} of the instances of C{cls} into
+        one typed array per attribute, without loading any objects.  The
+        view it needs (which emits just those attributes) is defined in the
+        C{'couchable-columns'} design doc, and synced the first time::
+
+            col_dict = cdb.columns(Foo, ['x', 'y'], 'dl')
+            col_dict['x'].mean()
+
+        The arrays are C{numpy} arrays if C{numpy} can be imported, and
+        C{array.array}s otherwise.  Their size is found first (with the
+        view's C{_count} reduce), so they're allocated once and filled a
+        page of rows at a time.  Instances where any of the attributes
+        isn't a number are left out, so the arrays always line up.
+
+        @type  cls: type
+        @param cls: The class to gather the attributes of.
+        @type  attrs: list of str
+        @param attrs: The attributes to gather (underscore attributes are fine).
+        @type  typecodes: str
+        @param typecodes: The C{array} typecode for each attribute, or one for all of them; raises ValueError for any other number of typecodes.
+        @type  pageSize: int
+        @param pageSize: How many rows to fetch per request.
+        @type  subclasses: bool
+        @param subclasses: Include subclasses (see L{defineClassView}).
+        @param kwargs: Passed along to C{couchdb.Database.view}; every row has the key C{[]}.
+        @rtype: collections.OrderedDict
+        @return: An array for each attribute name, in the order given.
+        """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if len(typecodes) == 1:
+            typecodes = typecodes * len(attrs)
+        if len(typecodes) != len(attrs):
+            raise ValueError("Got {} typecodes ({!r}) for {} attrs ({!r})".format(len(typecodes), typecodes, len(attrs), attrs))
+
+        value_list = ['info.private.' + attr if attr[0] == '_' else 'doc.' + attr for attr in attrs]
+        condition = ' && '.join(["typeof {} == 'number'".format(value_js) for value_js in value_list])
+
+        name = 'columns-{}{}'.format('-'.join(attrs), '-sub' if subclasses else '')
+        fullName = defineClassView(cls, name, [], value='[{}]'.format(', '.join(value_list)), reduce='_count',
+                designDoc='couchable-columns', subclasses=subclasses, condition=condition)
+        viewName = 'couchable-columns/' + fullName
+
+        self.syncViews(['couchable-columns'])
+
+        count_list = self.db.view(viewName, **kwargs).rows
+        count = count_list[0].value if count_list else 0
+
+        if numpy is not None:
+            column_list = [numpy.empty(count, typecode) for typecode in typecodes]
+        else:
+            column_list = [array.array(typecode, [0]) * count for typecode in typecodes]
+
+        if _trace_api.on:
+            _trace_api('CouchableDb.columns({}, {!r}) using {}: {} rows', typestr(cls), attrs, viewName, count)
+
+        filled = 0
+        for row_list in self._iterViewPages(viewName, pageSize, True, dict(kwargs, reduce=False), False):
+            value_list = [row['value'] for row in row_list]
+            end = filled + len(value_list)
+
+            # Instances may have been added since the count.
+            if end > count:
+                if numpy is not None:
+                    column_list = [numpy.resize(column, end) for column in column_list]
+                else:
+                    column_list = [column + array.array(column.typecode, [0]) * (end - count) for column in column_list]
+                count = end
+
+            for i, column in enumerate(column_list):
+                if numpy is not None:
+                    column[filled:end] = [value[i] for value in value_list]
+                else:
+                    column[filled:end] = array.array(column.typecode, [value[i] for value in value_list])
+
+            filled = end
+
+        return collections.OrderedDict((attr, column if len(column) == filled else column[:filled]) for attr, column in zip(attrs, column_list))
+
+    def storeAsync(self, what, skip=None, additiveOnly=False, callback=None):
+        """
+        Like L{store}, but runs on a process-wide pool of background threads
+        and returns right away.  Several stores (and loads) can be waiting
+        on CouchDB at the same time this way.
+
+        @type  callback: callable
+        @param callback: Called from the pool thread with the result of L{store}, if it succeeds.
+        @rtype: multiprocessing.pool.AsyncResult
+        @return: Call C{.get()} on this for the result of L{store} (or to have its exception raised).
+        """
+        return _getThreadPool().apply_async(self.store, (what, skip, additiveOnly), callback=callback)
+
+    def loadAsync(self, what, loaded=None, callback=None):
+        """
+        Like L{load}, but runs on a background thread; see L{storeAsync}.
+
+        @rtype: multiprocessing.pool.AsyncResult
+        @return: Call C{.get()} on this for the result of L{load}.
+        """
+        return _getThreadPool().apply_async(self.load, (what, loaded), callback=callback)
+
+    def loadViewAsync(self, viewName, callback=None, **kwargs):
+        """
+        Like L{loadView}, but runs on a background thread; see L{storeAsync}.
+
+        @rtype: multiprocessing.pool.AsyncResult
+        @return: Call C{.get()} on this for the result of L{loadView}.
+        """
+        return _getThreadPool().apply_async(self.loadView, (viewName,), kwargs, callback)
+
+
+# The unwrapped handlers for the types that CouchableDb._pack_iter walks itself.
+# Kept in a tuple so that doctest doesn't go looking for their docstrings.
+_walked_handler_tuple = (_pack_handlers[object], _pack_handlers[int], _pack_handlers[list], _pack_handlers[dict])
+
+class StoreSession(object):
+    """
+    A unit of work for L{CouchableDb.store}; see L{CouchableDb.session}.
+    """
+
+    def __init__(self, cdb, skip=None, additiveOnly=False):
+        self.cdb = cdb
+        self.skip = skip
+        self.additiveOnly = additiveOnly
+
+        self.obj_dict = collections.OrderedDict()
+        self.conflict_list = []
+        self._outer = None
+
+    def add(self, store_list):
+        """
+        Records objects to be stored when the session exits.
+        """
+        for obj in store_list:
+            if not hasattr(obj, '_id'):
+                newid(obj)
+
+            self.obj_dict[obj._id] = obj
+
+    def __enter__(self):
+        self._outer = getattr(self.cdb._local, 'session', None)
+        if self._outer is None:
+            self.cdb._local.session = self
+
+        return self._outer or self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._outer is not None:
+            return
+
+        del self.cdb._local.session
+
+        if exc_type is None and self.obj_dict:
+            self.cdb._storeList(list(self.obj_dict.values()), self.skip, self.additiveOnly, self.conflict_list)
+
+            if self.conflict_list:
+                raise StoreConflictException("{} doc(s) could not be stored: {}".format(len(self.conflict_list), ', '.join(obj._id for obj, e in self.conflict_list)), self.conflict_list)
+
+class _WriteBehind(object):
+    """
+    The queue and background thread behind L{CouchableDb.startWriteBehind}.
+    """
+
+    def __init__(self, cdb, maxsize, batchSize, errback=None):
+        self.cdb = cdb
+        self.maxsize = maxsize
+        self.batchSize = batchSize
+        self.errback = errback or (lambda obj, e: log_api.error("Write-behind store of {} failed: {!r}".format(obj._id, e)))
+
+        self._cond = threading.Condition()
+        self._todo_dict = collections.OrderedDict()
+        self._busy = False
+        self._closed = False
+
+        # Number of batches written so far; store() reads it before packing.
+        self.batchCount = 0
+
+        # _id -> (_rev sent, _rev written, batchCount after the write) for
+        # docs written by this thread.
+        self._rev_dict = collections.OrderedDict()
+
+        self._thread = threading.Thread(target=self._run, name='couchable-writeBehind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, todo_list, batchCount):
+        """
+        Queues the output of L{CouchableDb._packList}, and returns the items
+        that couldn't be queued because L{close} has been called; the caller
+        has to write those itself.  Everything that did get queued is
+        written before the background thread exits.
+        """
+        with self._cond:
+            try:
+                for i, todo_tup in enumerate(todo_list):
+                    _id = todo_tup[1]['_id']
+
+                    # Backpressure: wait for the background thread to make room.
+                    while not self._closed and _id not in self._todo_dict and len(self._todo_dict) >= self.maxsize:
+                        self._cond.wait()
+
+                    if self._closed:
+                        return todo_list[i:]
+
+                    self._todo_dict[_id] = (todo_tup, batchCount)
+            finally:
+                self._cond.notify_all()
+
+        return []
+
+    def flush(self):
+        with self._cond:
+            while self._todo_dict or self._busy:
+                self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._todo_dict and not self._closed:
+                    self._cond.wait()
+
+                # Only exits once closed and empty; put() doesn't queue
+                # anything after close(), so nothing queued is left behind.
+                if not self._todo_dict:
+                    return
+
+                todo_list = []
+                while self._todo_dict and len(todo_list) < self.batchSize:
+                    todo_tup, batchCount = self._todo_dict.popitem(False)[1]
+                    obj, doc, attachment_dict = todo_tup
+
+                    # A doc packed while this thread was writing the previous
+                    # version carries the _rev from before that write; any
+                    # other out of date _rev should still conflict.
+                    rev_tup = self._rev_dict.get(doc['_id'])
+                    if rev_tup is not None and doc.get('_rev') == rev_tup[0] and batchCount < rev_tup[2]:
+                        doc['_rev'] = rev_tup[1]
+
+                    todo_list.append(todo_tup)
+
+                self._busy = True
+                self._cond.notify_all()
+
+            error_list = []
+            sent_list = [doc.get('_rev') for obj, doc, attachment_dict in todo_list]
+            try:
+                self.cdb._writeList(todo_list, error_list)
+            except Exception, e:
+                log_internal.exception("Error writing batch")
+                error_list = [(obj, e) for obj, doc, attachment_dict in todo_list]
+
+            with self._cond:
+                self.batchCount += 1
+
+                failed_set = set(id(obj) for obj, e in error_list)
+                for (obj, doc, attachment_dict), sent_rev in itertools.izip(todo_list, sent_list):
+                    self._rev_dict.pop(doc['_id'], None)
+                    if id(obj) not in failed_set:
+                        self._rev_dict[doc['_id']] = (sent_rev, obj._rev, self.batchCount)
+
+                while len(self._rev_dict) > self.maxsize + self.batchSize:
+                    self._rev_dict.popitem(False)
+
+            for obj, e in error_list:
+                try:
+                    self.errback(obj, e)
+                except Exception:
+                    log_internal.exception("Error in write-behind errback")
+
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+class _RecordLoadedDict(dict):
+    """
+    The C{loaded_dict} for read-only loads (see L{CouchableDb._loadRecord});
+    its type tells L{CouchableDb._unpack_str} to make records for referenced
+    docs too.  Also keeps the records made so far, and the ids of the ones
+    being made (for cycles).
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.record_dict = {}
+        self.active_set = set()
+
+# (class, field names) to record classes, see _recordClass.
+_recordCls_cache = {}
+def _recordClass(cls, name_tup):
+    """
+    Returns a read-only tuple subclass with a property for each name in
+    C{name_tup}, and no C{__dict__}.
+
+    >>> rec = _recordClass(UncouchableException, ('_id', 'a'))(('x', 1))
+    >>> rec
+    <UncouchableExceptionRecord _id='x', a=1>
+    >>> rec.a, rec._cls.__name__
+    (1, 'UncouchableException')
+    """
+    key = (cls, name_tup)
+    record_cls = _recordCls_cache.get(key)
+
+    if record_cls is None:
+        def __repr__(self):
+            return '<{} {}>'.format(type(self).__name__, ', '.join('{}={!r}'.format(name, value) for name, value in zip(self._fields, self)))
+
+        ns_dict = {'__slots__': (), '_fields': name_tup, '_cls': cls, '__repr__': __repr__}
+        for i, name in enumerate(name_tup):
+            ns_dict[name] = property(operator.itemgetter(i))
+
+        record_cls = _recordCls_cache[key] = type(cls.__name__ + 'Record', (tuple,), ns_dict)
+
+    return record_cls
+
+class _LoadRequest(object):
+    """
+    One id that a L{CoalescingLoader} has been asked for; every caller that
+    wants the id waits on the same request.
+    """
+    __slots__ = ('event', 'obj', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.obj = None
+        self.error = None
+
+class CoalescingLoader(object):
+    """
+    Batches up L{CouchableDb.load} calls made from many threads at about
+    the same time.  The first id asked for starts a batch; ids asked for
+    in the next C{window} seconds (or until there are C{batchSize} of
+    them) get added to it, and then the whole batch is fetched with a
+    single C{_all_docs} request.  Asking for an id that is already part
+    of a pending or running batch just waits for that batch.
+
+    The objects come out of C{cdb.load}, so the usual identity map applies
+    (the same id always gives the same object).
+
+    Example use::
+
+        loader = CoalescingLoader(cdb)
+        obj = loader.load(_id)  # From any number of threads.
+    """
+
+    def __init__(self, cdb, window=0.005, batchSize=100):
+        """
+        @type  cdb: CouchableDb
+        @param cdb: The CouchableDb to load from.
+        @type  window: float
+        @param window: How many seconds to wait for more ids before fetching a batch.
+        @type  batchSize: int
+        @param batchSize: The most ids to fetch at once; a full batch is fetched without waiting out the window.
+        """
+        self.cdb = cdb
+        self.window = window
+        self.batchSize = batchSize
+
+        self._lock = threading.Lock()
+        self._request_dict = {}
+        self._batch_dict = None
+        self._batchFull_event = None
+
+    def load(self, what):
+        """
+        @type  what: str or list
+        @param what: A document C{_id}, or a list of them.
+        @rtype: obj or list
+        @return: The loaded object, or a list of them if C{what} was a list.
+        """
+        if not isinstance(what, list):
+            return self.load([what])[0]
+
+        request_list = []
+        leader_list = []
+
+        with self._lock:
+            for _id in what:
+                request = self._request_dict.get(_id)
+
+                if request is None:
+                    if self._batch_dict is None:
+                        self._batch_dict = collections.OrderedDict()
+                        self._batchFull_event = threading.Event()
+                        leader_list.append((self._batch_dict, self._batchFull_event))
+
+                    request = self._request_dict[_id] = self._batch_dict[_id] = _LoadRequest()
+
+                    # Full batches stop taking new ids; the next id starts a new batch.
+                    if len(self._batch_dict) >= self.batchSize:
+                        self._batchFull_event.set()
+                        self._batch_dict = None
+
+                request_list.append(request)
+
+        # Whoever started a batch is the one who fetches it.
+        for batch_dict, batchFull_event in leader_list:
+            batchFull_event.wait(self.window)
+
+            with self._lock:
+                if self._batch_dict is batch_dict:
+                    self._batch_dict = None
+
+            self._fetch(batch_dict)
+
+        obj_list = []
+        for request in request_list:
+            request.event.wait()
+
+            if request.error is not None:
+                raise request.error
+
+            obj_list.append(request.obj)
+
+        return obj_list
+
+    def _fetch(self, batch_dict):
+        try:
+            try:
+                for request, obj in itertools.izip(batch_dict.values(), self.cdb.load(list(batch_dict))):
+                    request.obj = obj
+            except Exception:
+                # Something in the batch is bad (a missing id, etc.), so find out which.
+                for _id, request in batch_dict.items():
+                    try:
+                        request.obj = self.cdb.load(_id)
+                    except Exception, e:
+                        request.error = e
+
+        finally:
+            with self._lock:
+                for _id in batch_dict:
+                    self._request_dict.pop(_id, None)
+
+            for request in batch_dict.values():
+                request.event.set()
 
 # Docs
 _couchable_types = collections.OrderedDict()
-def registerDocType(type_, preStore_func=(lambda obj, cdb: None), postLoad_func=(lambda obj, cdb: None)):
+_index_dict = {}
+def registerDocType(type_, preStore_func=(lambda obj, cdb: None), postLoad_func=(lambda obj, cdb: None), indexes=None):
     """
     @type  type_: type
     @param type_: Instances of this type will be stored as top-level CouchDB documents.
@@ -1311,13 +3596,25 @@ def registerDocType(type_, preStore_func=(lambda obj, cdb: None), postLoad_func=
     @param preStore_func: A callback of the form C{lambda obj, cdb: None}, called just before storing the object.
     @type  postLoad_func: callable
     @param postLoad_func: A callback of the form C{lambda obj, cdb: None}, called just after loading the object.
+    @type  indexes: list
+    @param indexes: Attribute names (or tuples of them, for compound indexes) to index, for L{CouchableDb.query}.  Underscore attributes are fine.  The views are defined with L{defineClassView}, in the design doc C{'couchable-index'}.
     @rtype: type
     @return: The C{type_} parameter.
 
     Example: C{registerDocType(CouchableDoc, lambda obj, cdb: obj.preStore(cdb), lambda obj, cdb: obj.postLoad(cdb))}
     """
-    _couchable_types[type_] = (preStore_func, postLoad_func)
-    _couchable_types[typestr(type_)] = (preStore_func, postLoad_func)
+    with _handler_lock:
+        _couchable_types[type_] = (preStore_func, postLoad_func)
+        _couchable_types[typestr(type_)] = (preStore_func, postLoad_func)
+
+    for attr_tup in indexes or []:
+        if isinstance(attr_tup, basestring):
+            attr_tup = (attr_tup,)
+        attr_tup = tuple(attr_tup)
+
+        fullName = defineClassView(type_, 'index-' + '-'.join(attr_tup), list(attr_tup), designDoc='couchable-index')
+        with _handler_lock:
+            _index_dict.setdefault(type_, collections.OrderedDict())[attr_tup] = 'couchable-index/' + fullName
 
     return type_
 
@@ -1405,10 +3702,12 @@ def newid(obj, id_func=None, noUuid=False, noType=False, sep=':'):
 
         # FIXME: I think this needs to be first for couchdb performance reasons.
         if not noUuid:
+            import uuid
             id_list.append(str(uuid.uuid1()))
 
         obj._id = sep.join(id_list).lstrip('_')
-        log_internal.debug("Assigning _id {} to {}".format(obj._id, obj))
+        if _trace_store.on:
+            _trace_store("Assigning _id {} to {}", obj._id, obj)
 
 # Attachments
 def doGzip(data, compresslevel=1):
@@ -1426,7 +3725,7 @@ def doGzip(data, compresslevel=1):
     @rtype: byte string
     @return: The compressed byte string.
     """
-    log_internal.debug("data len {}".format(len(data)))
+    _trace_compress("data len {}", len(data))
 
     str_io = cStringIO.StringIO()
     gz_file = gzip.GzipFile(mode='wb', compresslevel=1, fileobj=str_io)
@@ -1452,7 +3751,7 @@ def doGunzip(data):
     @rtype: byte string
     @return: The uncompressed byte string.
     """
-    log_internal.debug("data len {}".format(len(data)))
+    _trace_compress("data len {}", len(data))
 
     str_io = cStringIO.StringIO(data)
     gz_file = gzip.GzipFile(mode='rb', fileobj=str_io)
@@ -1468,11 +3767,11 @@ def doGunzip(data):
     return read_csio.getvalue()
 
 def doPickle(obj):
-    log_internal.debug("obj {}".format(type(obj)))
+    _trace_compress("obj {}", type(obj))
     return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
 
 def doUnpickle(data):
-    log_internal.debug("data len {}".format(len(data)))
+    _trace_compress("data len {}", len(data))
     return pickle.loads(data)
 
 
@@ -1506,9 +3805,10 @@ def registerAttachmentType(type_,
     else:
         handler_tuple = (serialize_func, deserialize_func, content_type)
 
-    _packer(type_)(CouchableDb._pack_attachment)
-    _attachment_handlers[type_] = handler_tuple
-    _attachment_handlers[typestr(type_)] = handler_tuple
+    with _handler_lock:
+        _packer(type_)(CouchableDb._pack_attachment)
+        _attachment_handlers[type_] = handler_tuple
+        _attachment_handlers[typestr(type_)] = handler_tuple
 
     return type_
 
@@ -1556,21 +3856,24 @@ registerAttachmentType(CouchableAttachment,
 
 
 def registerPickleType(type_):
-    _pack_handlers[type_] = CouchableDb._pack_pickle
-    _pack_handlers[typestr(type_)] = CouchableDb._pack_pickle
+    with _handler_lock:
+        _pack_handlers[type_] = CouchableDb._pack_pickle
+        _pack_handlers[typestr(type_)] = CouchableDb._pack_pickle
 
 def registerNoneType(type_):
     handler = lambda self, parent_doc, data, attachment_dict, name, isKey: CouchableDb._pack_native_keyAsRepr(self, parent_doc, None, attachment_dict, name, isKey)
 
-    _pack_handlers[type_] = handler
-    _pack_handlers[typestr(type_)] = handler
+    with _handler_lock:
+        _pack_handlers[type_] = handler
+        _pack_handlers[typestr(type_)] = handler
 
 def registerUncouchableType(type_):
     def handler(self, parent_doc, data, attachment_dict, name, isKey):
         raise UncouchableException("Type registered as uncouchable: {} at {}".format(type_, name), type_, data)
 
-    _pack_handlers[type_] = handler
-    _pack_handlers[typestr(type_)] = handler
+    with _handler_lock:
+        _pack_handlers[type_] = handler
+        _pack_handlers[typestr(type_)] = handler
 
 
 def findBadJson(obj, prefix=''):
@@ -20,16 +20,21 @@
 
 
 # stdlib
+import array
 import collections
 import copy
 import cPickle as pickle
 import datetime
 import doctest
 import gc
+import os
+import logging
 import random
 import re
 import sys
+import threading
 import time
+import traceback
 import unittest
 
 # 3rd party packages
@@ -67,6 +72,11 @@ class Simple(object):
     def __eq__(self, other):
         return type(self) == type(other) and vars(self) == vars(other)
 
+class DeepNode(object):
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
 class SimpleKey(Simple):
     def __eq__(self, other):
         return hash(self) == hash(other)
@@ -88,6 +98,12 @@ class SimpleDoc(couchable.CouchableDoc):
     def __repr__(self):
         return '<{!r} {!r} at {:#08x}>'.format(type(self), vars(self), id(self))
 
+class SubDoc(SimpleDoc):
+    pass
+
+class SubSubDoc(SubDoc):
+    pass
+
 class SimpleAttachment(couchable.CouchableAttachment):
     def __init__(self, **kwargs):
         for name, value in kwargs.items():
@@ -102,6 +118,13 @@ couchable.registerDocType(AftermarketDoc,
         lambda obj, cdb: couchable.newid(obj, lambda x: '-'.join(sorted(x.__dict__.keys()))),
         lambda obj, cdb: None)
 
+class IndexedDoc(object):
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+couchable.registerDocType(IndexedDoc, indexes=['x', ('name', 'x'), '_secret'])
+
 class AftermarketAttachment(object):
     def __init__(self, **kwargs):
         for name, value in kwargs.items():
@@ -118,6 +141,9 @@ class DictSubclass(dict):
     def __getitem__(self, key):
         return 'foo'
 
+class DictSubclassChild(DictSubclass):
+    pass
+
 class ListSubclass(list):
     def __iter__(self):
         return iter('foo')
@@ -271,12 +297,68 @@ class TestCouchable(unittest.TestCase):
 
         print 'exists w/ flag', t1-t0
 
+        t0 = time.time()
+        cdb_list = [couchable.CouchableDb('testing_couchable_' + str(i), lazy=True) for i in range(n)]
+        t1 = time.time()
+
+        print 'lazy', t1-t0
+
         for cdb in cdb_list:
             del couchdb.Server(cdb.server_url)[cdb.name]
 
         #assert False
 
 
+    @attr('couchable')
+    def test_1_connection_31_lazy(self):
+        name = 'testing_couchable_lazy'
+        if name in self.server:
+            del self.server[name]
+        couchable.core._existingDb_set.discard('http://localhost:5984/' + name)
+
+        try:
+            cdb = couchable.CouchableDb(name, lazy=True)
+            self.assertNotIn(name, self.server)
+
+            _id = cdb.store(Simple(a=1))
+            self.assertIn(name, self.server)
+
+            cdb = couchable.CouchableDb(name, lazy=True)
+            self.assertEqual(cdb.load(_id).a, 1)
+            self.assertIn(cdb.url, couchable.core._existingDb_set)
+        finally:
+            if name in self.server:
+                del self.server[name]
+
+    @attr('couchable')
+    def test_1_connection_40_sharedSession(self):
+        cdb1 = couchable.CouchableDb('testing_couchable', exists=True)
+        cdb2 = couchable.CouchableDb('testing_couchable_xxx')
+        cdb3 = couchable.CouchableDb('testing_couchable', timeout=30, poolSize=2)
+
+        try:
+            self.assertIs(cdb1.db.resource.session, cdb2.db.resource.session)
+            self.assertIs(cdb1.server.resource.session, cdb1.db.resource.session)
+            self.assertIsNot(cdb3.db.resource.session, cdb1.db.resource.session)
+
+            session = cdb3.db.resource.session
+            pid = os.fork()
+            if pid == 0:
+                ok = False
+                try:
+                    ok = cdb3.db.resource.session is not session \
+                            and cdb3.db.resource.session.connection_pool.timeout == 30 \
+                            and cdb3.db.resource.session.connection_pool.maxsize == 2 \
+                            and cdb3.db.resource.session is cdb3.server.resource.session \
+                            and cdb3.store(Simple(child=True))
+                finally:
+                    os._exit(0 if ok else 1)
+
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertIs(cdb3.db.resource.session, session)
+        finally:
+            del couchdb.Server(cdb2.server_url)[cdb2.name]
+
     @attr('couchable')
     def test_1_simple(self):
         obj = Simple(**self.simple_dict)
@@ -788,6 +870,668 @@ class TestCouchable(unittest.TestCase):
 
         #assert False
 
+    @attr('couchable')
+    def test_41_columnar(self):
+        cdb = couchable.CouchableDb('testing_couchable', columnarMinLen=10)
+
+        obj = Simple(l=[Simple(i=i, s=str(i), t=(i,)) for i in range(50)], short=[Simple(i=1)], mixed=[Simple(i=i) for i in range(9)] + [Simple(j=1)] * 10)
+
+        _id = cdb.store(obj)
+
+        doc = cdb.db[_id]
+        self.assertEqual(doc['l']['couchable:']['columnar'], 50)
+        self.assertEqual(doc['l']['i'], range(50))
+        self.assertIsInstance(doc['short'], list)
+        self.assertIsInstance(doc['mixed'], list)
+
+        del obj
+        gc.collect()
+        self.assertFalse(cdb._obj_by_id, repr(cdb._obj_by_id.items()))
+
+        obj = cdb.load(_id)
+
+        self.assertEqual(len(obj.l), 50)
+        self.assertEqual(obj.l[7], Simple(i=7, s='7', t=(7,)))
+        self.assertEqual(obj.short, [Simple(i=1)])
+        self.assertEqual(len(obj.mixed), 19)
+
+    @attr('couchable')
+    def test_41_sharedRefs(self):
+        cdb = couchable.CouchableDb('testing_couchable', shareRefs=True)
+
+        config = Simple(name='shared', data=range(100))
+        a = Simple(config=config)
+        b = Simple(config=config, parent=a)
+        a.child = b
+        obj = Simple(a=a, b=b, l=[config] * 10, d={'x': config})
+
+        _id = cdb.store(obj)
+
+        doc = cdb.db[_id]
+        self.assertEqual(repr(doc).count("'shared'"), 1)
+
+        del obj, a, b, config
+        gc.collect()
+
+        obj = cdb.load(_id)
+
+        self.assertIs(obj.a.child, obj.b)
+        self.assertIs(obj.b.parent, obj.a)
+        self.assertIs(obj.a.config, obj.b.config)
+        self.assertIs(obj.d['x'], obj.a.config)
+        self.assertEqual(set(map(id, obj.l)), {id(obj.a.config)})
+        self.assertEqual(obj.a.config.data, range(100))
+
+        cdb = couchable.CouchableDb('testing_couchable')
+        self.assertRaises(ValueError, cdb.store, obj)
+
+    @attr('couchable')
+    def test_42_arrays(self):
+        cdb = couchable.CouchableDb('testing_couchable', arrayMinLen=100)
+
+        f = [random.random() for i in range(5000)]
+        i = range(-1000, 1000)
+        obj = Simple(f=f, i=i, short=[1.0, 2.0], big=[2**40] * 200, t=tuple(i))
+
+        _id = cdb.store(obj)
+
+        doc = cdb.db[_id]
+        self.assertTrue(doc['f'].startswith('couchable:array:d:attachment:'))
+        self.assertIn('self.f', doc['_attachments'])
+        self.assertTrue(doc['i'].startswith('couchable:array:i:'))
+        self.assertEqual(doc['short'], [1.0, 2.0])
+        self.assertIsInstance(doc['big'], list)
+
+        del obj
+        gc.collect()
+        self.assertFalse(cdb._obj_by_id, repr(cdb._obj_by_id.items()))
+
+        obj = cdb.load(_id)
+
+        self.assertEqual(obj.f, f)
+        self.assertEqual(obj.i, i)
+        self.assertEqual(obj.short, [1.0, 2.0])
+        self.assertEqual(obj.big, [2**40] * 200)
+        self.assertEqual(obj.t, tuple(i))
+
+    @attr('couchable')
+    def test_43_deepNesting(self):
+        head = None
+        for i in range(500):
+            head = node = DeepNode(i=i, l=[[i]], next=head)
+
+        _id = self.cdb.store(DeepNode(head=head))
+
+        del head
+        del node
+        gc.collect()
+        self.assertFalse(self.cdb._obj_by_id, repr(self.cdb._obj_by_id.items()))
+
+        obj = self.cdb.load(_id)
+
+        node = obj.head
+        for i in reversed(range(500)):
+            self.assertEqual(node.i, i)
+            self.assertEqual(node.l, [[i]])
+            node = node.next
+        self.assertIs(node, None)
+
+    @attr('couchable')
+    def test_43_deepNestingNoJson(self):
+        limit = sys.getrecursionlimit()
+        try:
+            sys.setrecursionlimit(200)
+
+            head = None
+            for i in range(5000):
+                head = DeepNode(i=i, next=head, t=(i,))
+            d = reduce(lambda d, i: {'d': [d]}, range(5000), {})
+
+            with self.cdb._storeContext() as ctx:
+                doc = self.cdb._pack({}, DeepNode(head=head, d=d), {}, 'self')
+            obj = self.cdb._unpack(doc, doc, {})
+
+            node = obj.head
+            for i in reversed(range(5000)):
+                self.assertEqual(node.t, (i,))
+                node = node.next
+            self.assertIs(node, None)
+
+            for i in range(5000):
+                d = d['d'][0]
+            self.assertEqual(d, {})
+
+            self.assertEqual(ctx.cycle_set, set())
+
+        finally:
+            sys.setrecursionlimit(limit)
+
+    @attr('slow', 'couchable')
+    def test_43_packTiming(self):
+        wide = {'rows': [{'a': i, 'b': 's', 'c': [i, 1.5, None], 'n': Simple(p=i, q='q')} for i in range(20000)]}
+        n = 3
+
+        t0 = time.time()
+        with self.cdb._storeContext() as ctx:
+            for i in range(n):
+                doc = self.cdb._pack({}, wide, {}, 'self')
+        t1 = time.time()
+        for i in range(n):
+            self.cdb._unpack(doc, doc, {})
+        t2 = time.time()
+
+        print 'pack', n * 20000 / (t1-t0), 'rows/s'
+        print 'unpack', n * 20000 / (t2-t1), 'rows/s'
+
+        self.assertEqual(ctx.cycle_set, set())
+
+    @attr('slow', 'couchable')
+    def test_44_tracingTiming(self):
+        class CountingHandler(logging.Handler):
+            count = 0
+            def emit(self, record):
+                self.count += 1
+
+        handler = CountingHandler()
+        logger = logging.getLogger('couchable')
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        data = [Simple(p=i, q=SimplePickle(x=i)) for i in range(2000)]
+        n = 5
+
+        try:
+            for enabled in (False, True):
+                couchable.setTracing(enabled=enabled)
+                count = handler.count
+
+                t0 = time.time()
+                with self.cdb._storeContext():
+                    for i in range(n):
+                        doc = {}
+                        self.cdb._pack(doc, data, {}, 'self')
+                        couchable.doGzip('x' * 1000)
+                t1 = time.time()
+
+                print 'tracing', enabled, n * 2000 / (t1-t0), 'objects/s'
+
+                if enabled:
+                    self.assertGreater(handler.count, count)
+                else:
+                    self.assertEqual(handler.count, count)
+        finally:
+            couchable.setTracing(enabled=False)
+            logger.removeHandler(handler)
+            logger.propagate = True
+
+    @attr('couchable')
+    def test_45_threads(self):
+        error_list = []
+        id_list = []
+
+        def worker(n):
+            try:
+                for i in range(10):
+                    shared = self.cdb.load(shared_id)
+                    obj = Simple(n=n, i=i, l=range(i), d={'x': Simple(y=i)}, doc=shared)
+                    _id = self.cdb.store(obj, additiveOnly=True)
+                    id_list.append(_id)
+
+                    loaded = self.cdb.load(_id)
+                    self.assertIs(loaded, obj)
+                    self.assertIs(loaded.doc, shared)
+            except Exception:
+                error_list.append(traceback.format_exc())
+
+        shared_id = self.cdb.store(SimpleDoc(name='shared'))
+
+        thread_list = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+
+        self.assertEqual(error_list, [])
+        self.assertEqual(len(set(id_list)), 80)
+
+        loaded_list = self.cdb.load(id_list)
+        self.assertEqual(len({id(obj.doc) for obj in loaded_list}), 1)
+        self.assertEqual(sorted((obj.n, obj.i) for obj in loaded_list), [(n, i) for n in range(8) for i in range(10)])
+
+    @attr('couchable')
+    def test_45_threadsLocking(self):
+        class Registered(object):
+            pass
+
+        done_list = []
+        def register():
+            couchable.registerPickleType(Registered)
+            done_list.append('register')
+
+        def store():
+            self.cdb.store(SimpleDoc(name='locked'))
+            done_list.append('store')
+
+        for lock, target in [(couchable.core._handler_lock, register), (self.cdb._obj_by_id_lock, store)]:
+            with lock:
+                thread = threading.Thread(target=target)
+                thread.start()
+                thread.join(0.5)
+                self.assertEqual(len(done_list), 0)
+            thread.join()
+            self.assertEqual(len(done_list), 1)
+            done_list.pop()
+
+        self.assertIn(Registered, couchable.core._pack_handlers)
+
+    @attr('couchable')
+    def test_46_coalescingLoader(self):
+        id_list = self.cdb.store([SimpleDoc(name=str(i)) for i in range(5)])
+
+        gc.collect()
+        self.assertFalse(self.cdb._obj_by_id, repr(self.cdb._obj_by_id.items()))
+
+        call_list = []
+        load = self.cdb.load
+        def counting_load(what, loaded=None):
+            call_list.append(what)
+            return load(what, loaded)
+        self.cdb.load = counting_load
+
+        loader = couchable.CoalescingLoader(self.cdb, window=0.05)
+        result_list = [None] * 20
+
+        def worker(i):
+            result_list[i] = loader.load(id_list[i % 5])
+
+        thread_list = [threading.Thread(target=worker, args=(i,)) for i in range(20)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+
+        self.assertLess(len(call_list), 5)
+        self.assertEqual(sorted(_id for what in call_list for _id in what), sorted(id_list))
+        for i, obj in enumerate(result_list):
+            self.assertIs(obj, result_list[i % 5])
+            self.assertEqual(obj.name, str(i % 5))
+
+        self.assertEqual(loader.load(id_list[:2]), result_list[:2])
+        self.assertRaises(Exception, loader.load, [id_list[0], 'no_such_id'])
+        self.assertIs(loader.load(id_list[0]), result_list[0])
+
+    @attr('couchable')
+    def test_47_session(self):
+        shared = SimpleDoc(name='shared')
+        a = Simple(doc=shared)
+        b = Simple(doc=shared)
+
+        call_list = []
+        update = self.cdb.db.update
+        def counting_update(documents, **options):
+            call_list.append([doc['_id'] for doc in documents])
+            return update(documents, **options)
+        self.cdb.db.update = counting_update
+
+        with self.cdb.session() as session:
+            a_id = self.cdb.store(a)
+            with self.cdb.session():
+                b_id = self.cdb.store([b, shared])[0]
+            self.cdb.store(a)
+
+            self.assertEqual(call_list, [])
+            self.assertIsNone(getattr(a, '_rev', None))
+
+        self.assertEqual(len(call_list), 1)
+        self.assertEqual(sorted(call_list[0]), sorted([a_id, b_id, shared._id]))
+        self.assertEqual(session.conflict_list, [])
+        self.assertIsNotNone(a._rev)
+
+        stale = self.cdb.load(a_id)
+        stale_rev = stale._rev
+        self.cdb.store(stale)
+        stale._rev = stale_rev
+
+        try:
+            with self.cdb.session() as session:
+                self.cdb.store([stale, b])
+        except couchable.core.StoreConflictException, e:
+            self.assertEqual([obj for obj, error in e.conflict_list], [stale])
+        else:
+            self.fail('StoreConflictException not raised')
+
+        self.assertEqual(session.conflict_list, e.conflict_list)
+        self.assertEqual(self.cdb.db[b_id]['_rev'], b._rev)
+
+    @attr('couchable')
+    def test_48_writeBehind(self):
+        call_list = []
+        update = self.cdb.db.update
+        def slow_update(documents, **options):
+            call_list.append(len(documents))
+            time.sleep(0.01)
+            return update(documents, **options)
+        self.cdb.db.update = slow_update
+
+        error_list = []
+        self.cdb.startWriteBehind(maxsize=5, batchSize=3, errback=lambda obj, e: error_list.append((obj, e)))
+        try:
+            obj = Simple(i=0, l=[])
+            obj_id = self.cdb.store(obj)
+            for i in range(1, 20):
+                obj.i = i
+                obj.l.append(i)
+                self.cdb.store(obj)
+
+            id_list = self.cdb.store([Simple(n=n) for n in range(20)])
+
+            self.cdb.flush()
+
+            self.assertEqual(error_list, [])
+            self.assertLess(sum(call_list), 40)
+            self.assertTrue(all(n <= 3 for n in call_list), call_list)
+            self.assertEqual(self.cdb.db[obj_id]['i'], 19)
+            self.assertEqual(self.cdb.db[obj_id]['l'], range(1, 20))
+            self.assertEqual([self.cdb.db[_id]['n'] for _id in id_list], range(20))
+
+            stale = self.cdb.load(obj_id)
+            stale_rev = stale._rev
+            self.cdb.store(stale)
+            self.cdb.flush()
+            stale._rev = stale_rev
+            self.cdb.store(stale)
+            self.cdb.flush()
+
+            self.assertEqual([obj for obj, e in error_list], [stale])
+
+            # A store through another CouchableDb while a batch is in flight
+            # must make the queued snapshots conflict, not be overwritten.
+            del error_list[:]
+            obj = Simple(i=0)
+            obj_id = self.cdb.store(obj)
+            self.cdb.flush()
+
+            entered = threading.Event()
+            release = threading.Event()
+            def blocked_update(documents, **options):
+                if threading.current_thread().name == 'couchable-writeBehind' and not release.is_set():
+                    entered.set()
+                    release.wait()
+                return update(documents, **options)
+            self.cdb.db.update = blocked_update
+
+            obj.i = 100
+            self.cdb.store(obj)
+            try:
+                entered.wait()
+                obj.i = 101
+                self.cdb.store(obj)
+
+                obj.i = 200
+                couchable.CouchableDb(db=self.cdb.db).store(obj)
+            finally:
+                release.set()
+            self.cdb.flush()
+
+            self.assertEqual([x for x, e in error_list], [obj, obj])
+            self.assertEqual(self.cdb.db[obj_id]['i'], 200)
+        finally:
+            self.cdb.close()
+
+        # A store() that read _writeBehind before close() writes the doc itself.
+        self.cdb.startWriteBehind(maxsize=1)
+        writeBehind = self.cdb._writeBehind
+        self.cdb.close()
+        self.cdb._writeBehind = writeBehind
+        try:
+            late_list = [Simple(n=n) for n in range(3)]
+            self.cdb.store(late_list)
+            self.assertEqual([self.cdb.db[late._id]['_rev'] for late in late_list], [late._rev for late in late_list])
+        finally:
+            self.cdb._writeBehind = None
+
+    @attr('couchable')
+    def test_49_retryUpdate(self):
+        obj_list = [Simple(n=0) for i in range(6)]
+        id_list = self.cdb.store(obj_list)
+
+        # Bump the revs of two of the docs behind couchable's back.
+        for _id in id_list[:2]:
+            doc = self.cdb.db[_id]
+            doc['n'] = 10
+            self.cdb.db.save(doc)
+
+        for obj in obj_list:
+            obj.n += 1
+        self.assertRaises(couchdb.http.ResourceConflict, self.cdb.store, obj_list)
+        self.assertEqual([self.cdb.db[_id]['n'] for _id in id_list], [10, 10, 1, 1, 1, 1])
+        self.assertEqual([self.cdb.db[_id]['_rev'] for _id in id_list[2:]], [obj._rev for obj in obj_list[2:]])
+
+        call_list = []
+        def update_func(todo_list):
+            call_list.append(len(todo_list))
+            for obj in todo_list:
+                obj.n += 1
+
+        self.assertEqual(self.cdb.storeRetryUpdate(update_func, obj_list, baseDelay=0.001), id_list)
+        self.assertEqual(call_list, [6, 2])
+        self.assertEqual([self.cdb.db[_id]['n'] for _id in id_list], [11, 11, 2, 2, 2, 2])
+        self.assertEqual(self.cdb.retryStats['conflicts'], 2)
+        self.assertEqual(self.cdb.retryStats['retries'], 1)
+
+        stale = obj_list[0]
+        stale._rev = self.cdb.db[stale._id]['_rev']
+        doc = self.cdb.db[stale._id]
+        self.cdb.db.save(doc)
+        self.assertRaises(couchdb.http.ResourceConflict, self.cdb.storeRetryUpdate, lambda obj: None, stale, maxRetries=0)
+
+        # A fresh object for a doc that already exists has no _rev to refresh.
+        fresh_id = self.cdb.store(Simple(n=0))
+        gc.collect()
+        fresh = Simple(n=0)
+        fresh._id = fresh_id
+
+        fresh_list = []
+        def fresh_func(obj):
+            fresh_list.append(obj)
+            obj.n += 1
+
+        self.assertEqual(self.cdb.storeRetryUpdate(fresh_func, fresh, baseDelay=0.001, maxRetries=5), fresh_id)
+        self.assertEqual(len(fresh_list), 2)
+        self.assertIs(fresh_list[1], fresh)
+        self.assertEqual(self.cdb.db[fresh_id]['n'], 1)
+        self.assertEqual(self.cdb.db[fresh_id]['_rev'], fresh._rev)
+
+        fresh.n = 5
+        self.cdb.store(fresh)
+        self.assertEqual(self.cdb.db[fresh_id]['n'], 5)
+
+        self.assertIsNone(self.cdb._writeBehind)
+        self.assertRaises(Exception, self.cdb.store, stale)
+
+    @attr('couchable')
+    def test_50_storeIter(self):
+        parent = SimpleDoc(name='parent')
+
+        def gen(parent):
+            for i in range(30):
+                yield Simple(i=i, parent=parent, a=SimpleAttachment(content='x' * 100))
+
+        call_list = []
+        update = self.cdb.db.update
+        def counting_update(documents, **options):
+            call_list.append([doc['_id'] for doc in documents])
+            return update(documents, **options)
+        self.cdb.db.update = counting_update
+
+        written_list = []
+        packList = self.cdb._packList
+        def recording_packList(store_list, skip=None, additiveOnly=False, written_set=None):
+            written_list.append(written_set)
+            return packList(store_list, skip, additiveOnly, written_set)
+        self.cdb._packList = recording_packList
+
+        result_list = list(self.cdb.storeIter(gen(parent), batchBytes=1000))
+        del self.cdb._packList
+
+        # Only referenced docs are remembered.
+        self.assertEqual(written_list[-1], set([parent._id]))
+
+        self.assertGreater(len(call_list), 3)
+        self.assertEqual(sum(map(len, call_list)), 31)
+        self.assertEqual(len(result_list), 31)
+        self.assertEqual(len(set(_id for obj, _id, _rev in result_list)), 31)
+        self.assertEqual([_id for batch in call_list for _id in batch].count(parent._id), 1)
+
+        self.cdb.db.update = update
+        self.assertTrue(all(obj._rev == _rev for obj, _id, _rev in result_list))
+
+        del parent
+        del result_list
+        gc.collect()
+        self.assertFalse(self.cdb._obj_by_id, repr(self.cdb._obj_by_id.items()))
+
+        obj_list = self.cdb.load([row.id for row in self.cdb.db.view('_all_docs', include_docs=True) if row.doc.get('i') is not None])
+        self.assertEqual(sorted(obj.i for obj in obj_list), range(30))
+        self.assertEqual(len(set(id(obj.parent) for obj in obj_list)), 1)
+        self.assertEqual(obj_list[0].parent.name, 'parent')
+        self.assertEqual(obj_list[0].a.content, 'x' * 100)
+
+        # The same object twice in one batch goes out in two requests.
+        twice = SimpleDoc(name='twice')
+        result_list = list(self.cdb.storeIter([twice, twice]))
+        self.assertEqual([_id for obj, _id, _rev in result_list], [twice._id] * 2)
+        self.assertEqual(self.cdb.db[twice._id]['_rev'], twice._rev)
+        self.assertTrue(twice._rev.startswith('2-'))
+
+    @attr('couchable')
+    def test_51_partialLoad(self):
+        obj = SimpleDoc(name='full', x=1, _y=2, big=SimpleAttachment(content='z' * 100000), child=SimpleDoc(name='child'))
+        _id = self.cdb.store(obj)
+        del obj
+        gc.collect()
+
+        get_list = []
+        get_attachment = couchdb.Database.get_attachment
+        def counting_get_attachment(db, id_or_doc, filename, default=None):
+            get_list.append(filename)
+            return get_attachment(db, id_or_doc, filename, default)
+        couchdb.Database.get_attachment = counting_get_attachment
+        try:
+            part = self.cdb.load(_id, fields=['name', '_y'])
+            self.assertEqual(get_list, [])
+        finally:
+            couchdb.Database.get_attachment = get_attachment
+
+        self.assertIsInstance(part, SimpleDoc)
+        self.assertEqual((part.name, part._y, part._id), ('full', 2, _id))
+        self.assertFalse(hasattr(part, 'x'))
+        self.assertFalse(hasattr(part, 'child'))
+        self.assertNotIn(_id, self.cdb._obj_by_id)
+        self.assertRaises(couchable.core.UncouchableException, self.cdb.store, part)
+
+        full = self.cdb.load(_id)
+        self.assertIsNot(full, part)
+        self.assertEqual(full.child.name, 'child')
+        self.assertIsNot(self.cdb.load(_id, fields=['child']).child, None)
+        self.assertIs(self.cdb.load(_id, fields=['child']).child, full.child)
+
+        fullName = self.cdb.addClassView(SimpleDoc, 'name', ['name'])
+        part_list = list(self.cdb.iterClass(SimpleDoc, 'name', fields=['name']))
+        self.assertEqual([sorted(vars(part)) for part in part_list], [['_couchablePartial', '_id', '_rev', 'name']] * 2)
+
+        # Either attribute can be the back-reference to the shared object.
+        cdb = couchable.CouchableDb(db=self.cdb.db, shareRefs=True)
+        shared = Simple(v=1)
+        shared_id = cdb.store(SimpleDoc(a=shared, z=shared))
+        self.assertEqual(cdb.load(shared_id, fields=['a']).a.v, 1)
+        self.assertEqual(cdb.load(shared_id, fields=['z']).z.v, 1)
+        self.assertEqual(sorted(vars(cdb.load(shared_id, fields=['z']))), ['_couchablePartial', '_id', '_rev', 'z'])
+
+    @attr('couchable')
+    def test_52_readOnlyLoad(self):
+        a = SimpleDoc(name='a', x=1, _y=2, s=Simple(t=(1, 2)), att=SimpleAttachment(content='zzz'), l=[SimpleDoc(name='b')])
+        a.l[0].a = a
+        _id = self.cdb.store(a)
+        del a
+        gc.collect()
+
+        postLoad_list = []
+        postLoad = SimpleDoc.postLoad
+        SimpleDoc.postLoad = lambda obj, cdb: postLoad_list.append(obj)
+        try:
+            rec = self.cdb.load(_id, readOnly=True)
+        finally:
+            SimpleDoc.postLoad = postLoad
+
+        self.assertEqual(postLoad_list, [])
+        self.assertFalse(self.cdb._obj_by_id, repr(self.cdb._obj_by_id.items()))
+
+        self.assertIsInstance(rec, tuple)
+        self.assertIs(rec._cls, SimpleDoc)
+        self.assertEqual((rec._id, rec.name, rec.x, rec._y), (_id, 'a', 1, 2))
+        self.assertEqual(rec.s.t, (1, 2))
+        self.assertEqual(rec.att.content, 'zzz')
+        self.assertEqual(rec.l[0].name, 'b')
+        self.assertEqual(rec.l[0].a, _id)
+        self.assertRaises(AttributeError, setattr, rec, 'x', 2)
+        self.assertFalse(hasattr(rec, '__dict__'))
+        self.assertIs(type(rec), type(self.cdb.load(_id, readOnly=True)))
+
+        self.assertEqual(self.cdb.load([_id], readOnly=True, fields=['x'])[0]._fields, ('_id', '_rev', 'x'))
+
+        self.cdb.addClassView(SimpleDoc, 'name', ['name'])
+        self.assertEqual([rec.name for rec in self.cdb.iterClass(SimpleDoc, 'name', readOnly=True)], ['a', 'b'])
+        self.assertFalse(self.cdb._obj_by_id, repr(self.cdb._obj_by_id.items()))
+
+    @attr('couchable')
+    def test_53_patchUpdates(self):
+        cdb = couchable.CouchableDb(db=self.cdb.db, patchUpdates=True)
+        a = SimpleDoc(name='a', x=1, l=range(2000), d={'y': 2, 'z': 3})
+        _id = cdb.store(a)
+        _rev = a._rev
+
+        update_list = []
+        update = cdb.db.update
+        cdb.db.update = lambda *args, **kwargs: update_list.append(args) or update(*args, **kwargs)
+
+        a.x = 2.0
+        a.d['y'] = 4
+        del a.d['z']
+        cdb.store(a)
+
+        self.assertEqual(update_list, [])
+        self.assertNotEqual(a._rev, _rev)
+        doc = self.cdb.db[_id]
+        self.assertEqual((doc['_rev'], doc['x'], doc['d'], len(doc['l'])), (a._rev, 2.0, {'y': 4}, 2000))
+
+        # Stale revs fall back to a full write, which then conflicts.
+        doc['name'] = 'b'
+        self.cdb.db.save(doc)
+        a.name = 'c'
+        self.assertRaises(couchdb.http.ResourceConflict, cdb.store, a)
+        self.assertEqual(len(update_list), 1)
+        self.assertEqual(self.cdb.db[_id]['name'], 'b')
+
+        a = self.cdb.load(_id)
+        a.l = range(10)
+        cdb.store(a)
+        self.assertEqual(len(update_list), 2)
+        self.assertEqual(self.cdb.db[_id]['l'], range(10))
+
+        # Only large docs are kept, up to _patchCacheBytes of them.
+        self.assertNotIn(_id, cdb._packed_dict)
+        patchCacheBytes = couchable.core._patchCacheBytes
+        couchable.core._patchCacheBytes = 25000
+        try:
+            big_list = [SimpleDoc(name='big', l=range(2000)) for i in range(3)]
+            cdb.store(big_list)
+        finally:
+            couchable.core._patchCacheBytes = patchCacheBytes
+
+        self.assertEqual(cdb._packed_dict.keys(), [big._id for big in big_list[1:]])
+        self.assertEqual(cdb._packed_bytes, sum(tup[2] for tup in cdb._packed_dict.values()))
+
     @attr('couchable')
     def test_nonStrKeys(self):
         d = {1234:'ints', (1,2,3,4):'tuples', frozenset([1,1,2,2,3,3]): 'frozenset', None: 'none', SimpleKey(this_is_a_key=True):'truth'}
@@ -912,6 +1656,310 @@ class TestCouchable(unittest.TestCase):
         self.assertEqual(a.s.sss, 'SSS')
         self.assertIs(a, b.a)
 
+    @attr('couchable')
+    def test_viewLoadingAsync(self):
+        result_list = [self.cdb.storeAsync(SimpleDoc(name=name, s=Simple(sss=name * 3))) for name in ('AAA', 'BBB', 'CCC')]
+        id_list = [result.get(10) for result in result_list]
+
+        gc.collect()
+        self.assertFalse(self.cdb._obj_by_id, repr(self.cdb._obj_by_id.items()))
+
+        fullName = self.cdb.addClassView(SimpleDoc, 'name', ['name'])
+
+        view_result = self.cdb.loadViewAsync('couchable/' + fullName, startkey=['BBB'], endkey=['CCC', {}])
+        load_result = self.cdb.loadAsync(id_list)
+
+        b, c = view_result.get(10)
+        a = load_result.get(10)[0]
+
+        self.assertEqual(a.name, 'AAA')
+        self.assertEqual(b.s.sss, 'BBBBBBBBB')
+        self.assertEqual(c.name, 'CCC')
+        self.assertIs(c, load_result.get()[2])
+
+        self.assertRaises(Exception, self.cdb.loadAsync('no_such_id').get, 10)
+
+    @attr('couchable')
+    def test_viewIterating(self):
+        # Three docs per key, so pages have to split runs of equal keys.
+        id_list = self.cdb.store([SimpleDoc(name='N{:02}'.format(i // 3), i=i) for i in range(25)])
+        fullName = self.cdb.addClassView(SimpleDoc, 'name', ['name'])
+
+        call_list = []
+        view = self.cdb.db.view
+        def counting_view(name, wrapper=None, **options):
+            if name != '_all_docs':
+                call_list.append(options)
+            return view(name, wrapper, **options)
+        self.cdb.db.view = counting_view
+
+        obj_list = list(self.cdb.iterClass(SimpleDoc, 'name', pageSize=4))
+        self.assertEqual(sorted(obj.i for obj in obj_list), range(25))
+        self.assertEqual([obj.name for obj in obj_list], sorted(obj.name for obj in obj_list))
+        self.assertEqual(len(call_list), 7)
+
+        del call_list[:]
+        obj_list = list(self.cdb.iterView('couchable/' + fullName, pageSize=2, prefetch=False, startkey=['N02'], endkey=['N05', {}]))
+        self.assertEqual(sorted(obj.i for obj in obj_list), range(6, 18))
+        self.assertEqual(len(call_list), 6)
+
+        obj_list = list(self.cdb.iterClass(SimpleDoc, 'name', pageSize=4, descending=True, limit=10))
+        self.assertEqual([obj.name for obj in obj_list], sorted((obj.name for obj in obj_list), reverse=True))
+        self.assertEqual(len(obj_list), 10)
+        self.assertEqual(len(set(obj_list)), 10)
+
+        obj_list = list(self.cdb.iterClass(SimpleDoc, 'name', pageSize=4, skip=5))
+        self.assertEqual(len(set(obj_list)), 20)
+        self.assertEqual(min(obj.name for obj in obj_list), 'N01')
+        self.assertRaises(TypeError, list, self.cdb.iterClass(SimpleDoc, 'name', keys=[['N01']]))
+
+    @attr('couchable')
+    def test_viewIteratingParallel(self):
+        self.cdb.store([SimpleDoc(name='N{:02}'.format(i // 3), i=i) for i in range(24)])
+        fullName = self.cdb.addClassView(SimpleDoc, 'name', ['name'])
+        viewName = 'couchable/' + fullName
+
+        thread_set = set()
+        load = self.cdb.load
+        def recording_load(what, loaded=None):
+            thread_set.add(threading.current_thread().name)
+            return load(what, loaded)
+        self.cdb.load = recording_load
+
+        obj_list = list(self.cdb.iterViewParallel(viewName, ranges=3, pageSize=4))
+        self.assertEqual(sorted(obj.i for obj in obj_list), range(24))
+        self.assertEqual(thread_set, set(['couchable-scan']))
+        self.assertEqual(len(self.cdb._viewSplits(viewName, 3, 4, {})), 2)
+
+        obj_list = list(self.cdb.iterViewParallel(viewName, ranges=3, pageSize=3, ordered=True, startkey=['N02'], endkey=['N06', {}]))
+        self.assertEqual([obj.i for obj in obj_list], sorted(obj.i for obj in obj_list))
+        self.assertEqual(sorted(obj.i for obj in obj_list), range(6, 21))
+
+        obj_list = list(self.cdb.iterViewParallel(viewName, ranges=2, pageSize=6, ordered=True, descending=True))
+        self.assertEqual([obj.name for obj in obj_list], sorted((obj.name for obj in obj_list), reverse=True))
+        self.assertEqual(len(obj_list), 24)
+
+        scan = self.cdb.iterViewParallel(viewName, ranges=3, pageSize=2)
+        self.assertEqual(len([obj for obj, i in zip(scan, range(5))]), 5)
+        scan.close()
+
+    @attr('couchable')
+    def test_viewSyncing(self):
+        self.cdb.store([SimpleDoc(name=name) for name in ('AAA', 'BBB', 'CCC')])
+
+        get_list = []
+        update_list = []
+        get = self.cdb.db.get
+        update = self.cdb.db.update
+        def counting_get(_id, default=None, **options):
+            get_list.append(_id)
+            return get(_id, default, **options)
+        def counting_update(documents, **options):
+            update_list.append([doc['_id'] for doc in documents])
+            return update(documents, **options)
+        self.cdb.db.get = counting_get
+        self.cdb.db.update = counting_update
+
+        design_list = ['couchable-test-a', 'couchable-test-b']
+        try:
+            for i in range(5):
+                couchable.defineClassView(SimpleDoc, 'sync{}'.format(i), ['name'], designDoc=design_list[i % 2])
+
+            self.assertEqual(self.cdb.syncViews(design_list), design_list)
+            self.assertEqual(sorted(get_list), ['_design/' + design for design in design_list])
+            self.assertEqual(update_list, [['_design/' + design for design in design_list]])
+            self.assertEqual(len(self.cdb.db['_design/couchable-test-a']['views']), 3)
+            rev_a = self.cdb.db['_design/couchable-test-a']['_rev']
+
+            del get_list[:], update_list[:]
+            self.assertEqual(self.cdb.syncViews(design_list), [])
+            self.assertEqual(couchable.CouchableDb('testing_couchable').syncViews(design_list), [])
+            self.assertEqual((get_list, update_list), ([], []))
+
+            couchable.defineClassView(SimpleDoc, 'sync1', ['name', 'name'], designDoc='couchable-test-b')
+            self.assertEqual(self.cdb.syncViews(design_list), ['couchable-test-b'])
+            self.assertEqual(update_list, [['_design/couchable-test-b']])
+            self.assertEqual(self.cdb.db['_design/couchable-test-a']['_rev'], rev_a)
+
+            self.assertEqual([obj.name for obj in self.cdb.iterClass(SimpleDoc, 'sync1')], ['AAA', 'BBB', 'CCC'])
+
+            # Another writer bumps the design doc between the fetch and the write.
+            competing_list = []
+            def competing_update(documents, **options):
+                if competing_list:
+                    doc = get(competing_list.pop())
+                    doc['views']['other'] = {'map': 'function(doc) {}'}
+                    self.cdb.db.save(doc)
+                return counting_update(documents, **options)
+            self.cdb.db.update = competing_update
+
+            del update_list[:]
+            competing_list.append('_design/couchable-test-a')
+            couchable.defineClassView(SimpleDoc, 'sync5', ['name'], designDoc='couchable-test-a')
+            self.assertEqual(self.cdb.syncViews(design_list), ['couchable-test-a'])
+            self.assertEqual(len(update_list), 2)
+            view_dict = self.cdb.db['_design/couchable-test-a']['views']
+            self.assertEqual(len(view_dict), 5)
+            self.assertIn('other', view_dict)
+
+            competing_list.extend(['_design/couchable-test-a'] * 3)
+            couchable.defineClassView(SimpleDoc, 'sync6', ['name'], designDoc='couchable-test-a')
+            self.assertRaises(couchdb.http.ResourceConflict, self.cdb.syncViews, design_list)
+            self.assertEqual(self.cdb.syncViews(design_list), ['couchable-test-a'])
+            self.assertEqual(len(self.cdb.db['_design/couchable-test-a']['views']), 6)
+        finally:
+            for key in list(couchable.core._classView_dict):
+                if key[0] in design_list:
+                    del couchable.core._classView_dict[key]
+
+    @attr('couchable')
+    def test_viewSubclasses(self):
+        cdb = couchable.CouchableDb('testing_couchable', classHierarchy=True)
+        cls_list = [SimpleDoc, SubDoc, SubSubDoc, Simple]
+        id_list = cdb.store([cls_list[x % 4](x=x) for x in range(12)])
+
+        self.assertEqual(cdb.db[id_list[2]]['couchable:']['mro'], map(couchable.core.typestr, [SubDoc, SimpleDoc, couchable.CouchableDoc]))
+
+        cdb.addClassView(SimpleDoc, 'x', ['x'], subclasses=True)
+        cdb.addClassView(SubDoc, 'x', ['x'], subclasses=True)
+        cdb.addClassView(SimpleDoc, 'xOnly', ['x'])
+
+        obj_list = list(cdb.iterClass(SimpleDoc, 'x', startkey=[3], endkey=[7, {}]))
+        self.assertEqual([(type(obj), obj.x) for obj in obj_list], [(SimpleDoc, 4), (SubDoc, 5), (SubSubDoc, 6)])
+        self.assertEqual([obj.x for obj in cdb.iterClass(SubDoc, 'x')], [1, 2, 5, 6, 9, 10])
+        self.assertEqual([obj.x for obj in cdb.iterClass(SimpleDoc, 'xOnly')], [0, 4, 8])
+
+        # Docs that aren't plain objects are packed another way.
+        child = DictSubclassChild(a=1)
+        child.x = 100
+        child_id = cdb.store(child)
+        self.assertEqual(cdb.db[child_id]['couchable:']['mro'], [couchable.core.typestr(DictSubclass), '__builtin__.dict'])
+
+        cdb.addClassView(DictSubclass, 'x', ['x'], subclasses=True)
+        self.assertEqual([(type(obj), obj.x) for obj in cdb.iterClass(DictSubclass, 'x')], [(DictSubclassChild, 100)])
+
+    @attr('couchable')
+    def test_query(self):
+        self.cdb.store([IndexedDoc(name='AB'[x % 2], x=x, _secret=x * 10) for x in range(20)])
+        self.cdb.store([SimpleDoc(name='A', x=x) for x in range(20)])
+
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, x=3)], [3])
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, x=[7, 3, 25])], [7, 3])
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, x=range(5, 9), pageSize=3)], range(5, 9))
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, x=slice(5, 9), pageSize=3)], range(5, 9))
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, x=slice(None, 2))], [0, 1])
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, x=slice(17, None))], [17, 18, 19])
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, name='B', x=slice(3, 9))], [3, 5, 7])
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, name=['A', 'B'], x=[2, 3])], [2, 3])
+        self.assertEqual([obj.x for obj in self.cdb.query(IndexedDoc, _secret=slice(100, 130))], [10, 11, 12])
+
+        self.assertRaises(ValueError, self.cdb.query, IndexedDoc, name='A')
+        self.assertRaises(ValueError, self.cdb.query, IndexedDoc, name=slice('A', 'B'), x=3)
+        self.assertRaises(ValueError, self.cdb.query, SimpleDoc, x=3)
+
+    @attr('couchable')
+    def test_viewLinked(self):
+        for i in range(3):
+            self.cdb.store(SimpleDoc(name='P{}'.format(i), child=SimpleDoc(name='C{}'.format(i)), kids=[SimpleDoc(name='K{}{}'.format(i, j)) for j in range(2)], _private=SimpleDoc(name='Q{}'.format(i))))
+        gc.collect()
+        self.assertFalse(self.cdb._obj_by_id, repr(self.cdb._obj_by_id.items()))
+
+        fullName = self.cdb.addClassView(SimpleDoc, 'linked', ['name'], linked=['child', 'kids', '_private'])
+
+        get_list = []
+        getitem = couchdb.Database.__getitem__
+        def counting_getitem(db, _id):
+            get_list.append(_id)
+            return getitem(db, _id)
+        couchdb.Database.__getitem__ = counting_getitem
+        try:
+            obj_list = self.cdb.loadView('couchable/' + fullName, startkey=['P'], endkey=['Q'])
+            self.assertEqual([obj.name for obj in obj_list], ['P0', 'P1', 'P2'])
+            self.assertEqual([obj.child.name for obj in obj_list], ['C0', 'C1', 'C2'])
+            self.assertEqual([[kid.name for kid in obj.kids] for obj in obj_list[:1]], [['K00', 'K01']])
+            self.assertEqual(obj_list[2]._private.name, 'Q2')
+            self.assertEqual(get_list, [])
+
+            obj_list = list(self.cdb.iterView('couchable/' + fullName, pageSize=2, startkey=['C'], endkey=['D']))
+            self.assertEqual([obj.name for obj in obj_list], ['C0', 'C1', 'C2'])
+        finally:
+            couchdb.Database.__getitem__ = getitem
+
+        # Views that emit whole docs as values aren't linked rows.
+        self.cdb.db.save({'_id': '_design/plain', 'views': {'bydoc': {'map': 'function(doc) { if (doc.name) { emit(doc.name, doc); } }'}}})
+        self.assertEqual([obj.name for obj in self.cdb.loadView('plain/bydoc', startkey='P', endkey='Q')], ['P0', 'P1', 'P2'])
+
+    @attr('couchable')
+    def test_aggregate(self):
+        self.cdb.store([SimpleDoc(kind='ab'[x % 2], x=x, _y=x * 10) for x in range(10)] + [SimpleDoc(kind='c', x='n/a')])
+        self.cdb.store([Simple(kind='a', x=100)])
+
+        load = self.cdb.load
+        self.cdb.load = None
+        try:
+            self.assertEqual(self.cdb.aggregate(SimpleDoc), 11)
+            self.assertEqual(self.cdb.aggregate(SimpleDoc, 'x', '_sum'), 45)
+            self.assertEqual(self.cdb.aggregate(SimpleDoc, '_y', '_sum'), 450)
+
+            stats = self.cdb.aggregate(SimpleDoc, 'x', '_stats')
+            self.assertEqual((stats['count'], stats['min'], stats['max']), (10, 0, 9))
+
+            self.assertEqual(self.cdb.aggregate(SimpleDoc, 'x', '_sum', by=['kind']), collections.OrderedDict([(('a',), 20), (('b',), 25)]))
+            self.assertEqual(self.cdb.aggregate(SimpleDoc, by=['kind', 'x'], group_level=1), collections.OrderedDict([(('a',), 5), (('b',), 5), (('c',), 1)]))
+            self.assertEqual(self.cdb.aggregate(SimpleDoc, by=['x'], startkey=[7], endkey=[{}]).keys(), [(7,), (8,), (9,), ('n/a',)])
+            self.assertEqual(self.cdb.aggregate(SubDoc), None)
+        finally:
+            self.cdb.load = load
+
+    @attr('couchable')
+    def test_columns(self):
+        self.cdb.store([SimpleDoc(x=x, _y=x * 0.5) for x in range(25)] + [SimpleDoc(x='n/a', _y=1.0), SimpleDoc(_y=2.0)])
+
+        # Without numpy, so the arrays are array.arrays (see test_columnsNumpy).
+        load = self.cdb.load
+        self.cdb.load = None
+        numpy = sys.modules.get('numpy')
+        sys.modules['numpy'] = None
+        try:
+            col_dict = self.cdb.columns(SimpleDoc, ['x', '_y'], 'ld', pageSize=10)
+        finally:
+            self.cdb.load = load
+            if numpy is None:
+                del sys.modules['numpy']
+            else:
+                sys.modules['numpy'] = numpy
+
+        self.assertEqual(col_dict.keys(), ['x', '_y'])
+        self.assertEqual(sorted(zip(col_dict['x'], col_dict['_y'])), [(x, x * 0.5) for x in range(25)])
+        self.assertEqual([type(column) for column in col_dict.values()], [array.array] * 2)
+        self.assertEqual([column.typecode for column in col_dict.values()], ['l', 'd'])
+
+        self.assertEqual(len(self.cdb.columns(SimpleDoc, ['_y'])['_y']), 27)
+        self.assertEqual(len(self.cdb.columns(SubDoc, ['x'])['x']), 0)
+        self.assertRaises(ValueError, self.cdb.columns, SimpleDoc, ['x', '_y'], 'ldd')
+
+    @attr('couchable')
+    def test_columnsNumpy(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("numpy isn't installed")
+
+        self.cdb.store([SimpleDoc(x=x, _y=x * 0.5) for x in range(25)])
+
+        # Grows the arrays, as if instances were added after the count.
+        view = self.cdb.db.view
+        def short_count_view(name, wrapper=None, **options):
+            if options.get('reduce') is None:
+                return collections.namedtuple('ViewResults', 'rows')([couchdb.client.Row(key=None, value=20)])
+            return view(name, wrapper, **options)
+        self.cdb.db.view = short_count_view
+
+        col_dict = self.cdb.columns(SimpleDoc, ['x', '_y'], 'ld', pageSize=10)
+        self.assertEqual([type(column) for column in col_dict.values()], [numpy.ndarray] * 2)
+        self.assertEqual([column.dtype.char for column in col_dict.values()], ['l', 'd'])
+        self.assertEqual(sorted(zip(col_dict['x'].tolist(), col_dict['_y'].tolist())), [(x, x * 0.5) for x in range(25)])
+
     @attr('couchable')
     def test_viewLoading2(self):
         a = SimpleDoc(name='AAA', s=Simple(sss='SSS'))
@@ -31,7 +31,6 @@ setup(
     packages=['couchable',],
     install_requires=[
             'CouchDb >= 0.8',
-            'requests',
         ],
     classifiers=[
             'Development Status :: 4 - Beta',